@@ -0,0 +1,199 @@
+'''
+Author: James Edwards
+
+This code benchmarks the hot paths of training and generating haikus, so that
+the effect of a change can be measured and compared between runs.
+
+For each corpus (the four seasonal training sets, plus synthetic corpora
+scaled up from them) and each n, it trains an NgramModel and measures:
+- train time
+- sequences per second from PDFSA.generate
+- haikus per second, the p50/p99 latency of a single haiku, and the
+  restarts, backtracks and line acceptance rate of the trial and error line
+  generator (PDFSA.haiku_helper) and the single pass constrained generator
+  (PDFSA.generate_constrained_line)
+- how often a line ends in a one syllable word
+- the dedupe rate of trial and error generation through a NoveltyFilter of the
+  season's training lines (see novelty.py)
+- the time taken by log_probability_of_test_set on another season's set
+- the peak memory of the process doing all of the above
+Each case runs in a fresh worker process so that its peak memory is its own.
+Results are written out as JSON.
+
+Run "python benchmark.py --help" for the options.
+'''
+
+import os, sys, random, time, json, platform, resource
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from ngrams import *
+from pdfsa import HaikuGenerationError
+from novelty import NoveltyFilter
+
+here = os.path.dirname(os.path.abspath(__file__))
+TRAINING_SETS = os.path.join(here, "Training Sets")
+SEASONS = ["Autumn", "Winter", "Spring", "Summer"]
+
+def training_file(season):
+    '''Returns the path of the training set for a season.'''
+    return os.path.join(TRAINING_SETS, season + " Training.txt")
+
+def synthetic_corpus(season, scale, seed=0):
+    '''Returns the training set for a season scaled up "scale" times: the real haikus,
+    followed by enough sequences generated from a bigram model of them to make up
+    the rest. The same seed always gives the same corpus.'''
+    haikus = open_as_haikus(training_file(season))
+    if scale <= 1:
+        return haikus
+    model = NgramModel(haikus, 2)
+    state = random.getstate()
+    random.seed(seed)
+    extra = []
+    while len(extra) < (scale - 1) * len(haikus):
+        sequence = model.fsa.generate()
+        if sequence:
+            extra.append(sequence)
+    random.setstate(state)
+    return haikus + extra
+
+def percentile(values, fraction):
+    '''Returns the value below which the given fraction of the sorted values fall.'''
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def benchmark_generation(model, count, constrained=False, seed=0, novelty=None):
+    '''Generates count haikus from model and returns a dictionary of statistics about
+    them: haikus per second, p50/p99 latency in seconds, total restarts and
+    backtracks, the fraction of started lines that were accepted, and the fraction
+    of lines ending in a one syllable word. If novelty (a NoveltyFilter) is given,
+    the haikus are generated through it and its dedupe rate is included; the
+    restarts, backtracks and acceptance rate then cover every line drawn, including
+    those thrown away.'''
+    random.seed(seed)
+    fsa = model.fsa
+    fsa.generate_haiku(constrained=constrained)    # Warm up caches and the lexicon
+    syllables_dict = fsa.make_syllable_dictionary(fsa.syllable_dictionary)
+    latencies = []
+    attempts = restarts = backtracks = short_endings = 0
+
+    # fsa.haiku_stats only holds the lines of the last haiku returned, so with novelty
+    # the statistics of each line are kept as it is checked, whether it is kept or not
+    drawn_stats = []
+    def accept_line(line):
+        drawn_stats.append(fsa.last_line_stats)
+        return novelty.accept_line(line)
+
+    start = time.time()
+    for i in range(count):
+        before = time.time()
+        if novelty is None:
+            haiku = fsa.generate_haiku(constrained=constrained)
+            line_stats = fsa.haiku_stats
+        else:
+            # As NgramModel.generate_haiku does
+            del drawn_stats[:]
+            haiku = fsa.generate_haiku(constrained=constrained, accept_line=accept_line)
+            while not novelty.accept(haiku[1:]):
+                haiku = fsa.generate_haiku(constrained=constrained, accept_line=accept_line)
+            line_stats = drawn_stats
+        latencies.append(time.time() - before)
+        for stats in line_stats:
+            attempts += stats.attempts
+            restarts += stats.restarts
+            backtracks += stats.backtracks
+        for line in haiku[1:]:
+            word = line.split(" ")[-1]
+            # Count the main pronunciation of known words, and estimate the rest
+            syllables = syllables_dict.get(word)
+            if syllables is None:
+                syllables = syllables_dict.pronunciations(word)[0]
+            if syllables == 1:
+                short_endings += 1
+    elapsed = time.time() - start
+    latencies.sort()
+    result = {"haikus_per_sec": count / elapsed,
+              "latency_p50": percentile(latencies, 0.50),
+              "latency_p99": percentile(latencies, 0.99),
+              "restarts": restarts,
+              "backtracks": backtracks,
+              "acceptance_rate": 3.0 * count / attempts,
+              "one_syllable_endings": short_endings / (3.0 * count)}
+    if novelty is not None:
+        result["dedupe_rate"] = novelty.dedupe_rate
+    return result
+
+def benchmark_case(case):
+    '''Runs every benchmark for one (season, scale, n, count, seed) case and returns
+    the results as a dictionary.'''
+    season, scale, n, count, seed = case
+    corpus = synthetic_corpus(season, scale, seed)
+    result = {"corpus": season, "scale": scale, "n": n, "sequences": len(corpus)}
+
+    start = time.time()
+    model = NgramModel(corpus, n)
+    result["train_time"] = time.time() - start
+    result["states"] = len(model.fsa.Q)
+    result["transitions"] = len(model.fsa.transitions)
+    del corpus
+
+    random.seed(seed)
+    start = time.time()
+    for i in range(count):
+        model.fsa.generate()
+    result["generate_per_sec"] = count / (time.time() - start)
+
+    for mode in ("haiku_helper", "constrained", "novel"):
+        novelty = None
+        if mode == "novel":
+            novelty = NoveltyFilter(iter_lines(training_file(season)), memory=count)
+        try:
+            result[mode] = benchmark_generation(model, count, mode == "constrained", seed, novelty)
+        except HaikuGenerationError as e:
+            result[mode] = {"error": str(e)}
+
+    test_season = SEASONS[(SEASONS.index(season) + 1) % len(SEASONS)]
+    test_corpus = open_as_haikus(training_file(test_season))
+    start = time.time()
+    model.log_probability_of_test_set(test_corpus, 0.1)
+    result["score_time"] = time.time() - start
+
+    # ru_maxrss is in kilobytes on Linux, and bytes on Mac OS X
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_memory_mb"] = peak / (1024.0 * 1024 if sys.platform == "darwin" else 1024.0)
+    return result
+
+def run_benchmarks(seasons=SEASONS, scales=(1,), ngrams=(2, 3, 4, 5), count=500, seed=0):
+    '''Runs benchmark_case for every combination of season, scale and n, each in a
+    fresh worker process, and returns the JSON-ready report.'''
+    cases = [(season, scale, n, count, seed) for scale in scales for season in seasons for n in ngrams]
+    pool = Pool(1, maxtasksperchild=1)
+    try:
+        results = [pool.apply(benchmark_case, (case,)) for case in cases]
+    finally:
+        pool.terminate()
+        pool.join()
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "count": count,
+            "seed": seed,
+            "results": results}
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark training, generation and scoring.")
+    parser.add_argument("--seasons", nargs="+", default=SEASONS, choices=SEASONS)
+    parser.add_argument("--scales", nargs="+", type=int, default=[1, 4],
+                        help="sizes of the corpora, as multiples of the training sets")
+    parser.add_argument("--ngrams", nargs="+", type=int, default=[2, 3, 4, 5])
+    parser.add_argument("--count", type=int, default=500, help="haikus generated per case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the JSON report to (default: stdout)")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.seasons, args.scales, args.ngrams, args.count, args.seed)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
@@ -0,0 +1,333 @@
+'''
+Author: James Edwards
+
+This code defines the SyllableLexicon class, a compact read-only table of
+words and their syllable counts, along with get_lexicon, which loads the
+syllable dictionary once per process so every PDFSA can share it.
+
+Words are kept in sorted order as a single string, joined by newlines, with an
+array of where each one starts, and are found by binary search. Parallel
+arrays hold the syllable count of each word's main pronunciation, and a bit
+mask of the syllable counts of all its pronunciations (bit k is set if some
+pronunciation has k syllables). This takes a few bytes per word on top of the
+words themselves, where a dictionary (or even a tuple) of strings takes dozens.
+A lexicon can be saved to (and loaded from) a pickled snapshot, which is much
+faster to read than a text file. The default snapshot is always made from
+the syllable dictionary text file: get_lexicon writes it the first time it
+reads the text file, and syllablesdict.py rebuilds both from the pronouncing
+dictionary.
+
+Words that aren't in the lexicon get their syllables estimated instead (see
+estimate_syllables and SyllableLexicon.pronunciations), with the estimates
+kept in a small least recently used cache.
+'''
+
+import os
+import re
+import cPickle
+from array import array
+from collections import OrderedDict
+
+# Bumped whenever the layout of a saved snapshot changes
+LEXICON_VERSION = 3
+
+# Syllable counts above this can't be stored in a mask and are capped at it
+MAX_SYLLABLES = 15
+
+here = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DICTIONARY = os.path.join(here, "syllableDictionary.txt")
+DEFAULT_SNAPSHOT = os.path.join(here, "syllableDictionary.lex")
+
+# Lexicons that have already been loaded, keyed by filename
+_lexicons = {}
+
+# How many estimated words each lexicon remembers
+ESTIMATE_CACHE_SIZE = 4096
+
+class LRUCache(object):
+    '''A cache of the results of a one argument function, holding at most maxsize of
+    them and forgetting the least recently used first. hits and misses count how
+    many calls were answered from the cache and how many weren't.'''
+
+    def __init__(self, function, maxsize):
+        self.function = function
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, key):
+        try:
+            result = self.results.pop(key)
+            self.hits += 1
+        except KeyError:
+            result = self.function(key)
+            self.misses += 1
+            if len(self.results) >= self.maxsize:
+                self.results.popitem(last=False)
+        # Put the key back at the most recently used end
+        self.results[key] = result
+        return result
+
+    def __len__(self):
+        return len(self.results)
+
+# Vowel groups that are usually said as two syllables, as in "lion", "video" or "fluent"
+SPLIT_VOWELS = re.compile("[^aeiou](?:io|ia|eo|ue|ua|uo)(?!n$|ns$|us$|l$|ls$)|[^aeiou]iet")
+
+def estimate_syllables(word):
+    '''Estimates the number of syllables in an English word from its spelling, for
+    words that aren't in the lexicon. Each group of vowels is counted as a syllable,
+    and then the count is adjusted with a few suffix rules:
+    - a final "e" is usually silent ("stone"), but not in "-le" after a consonant ("maple")
+    - "-es" and "-ed" are usually silent ("stones", "walked"), but not after
+      "s", "x", "z", "ch", "sh", "ce" or "ge" for "-es" ("branches"), or "t" or "d" for "-ed"
+    - some pairs of vowels are two syllables ("lion")
+    Every word has at least one syllable.
+    '''
+    letters = re.sub("[^a-z]", "", word.lower())
+    if not letters:
+        return 1
+    syllables = len(re.findall("[aeiouy]+", letters))
+    if letters.endswith("e") and not letters.endswith(("ee", "ye")):
+        if not (letters.endswith("le") and len(letters) > 2 and letters[-3] not in "aeiouy"):
+            syllables -= 1
+    elif letters.endswith("es") and len(letters) > 3 and letters[-3] not in "aeiouy":
+        if not letters.endswith(("ses", "xes", "zes", "ches", "shes", "ces", "ges")):
+            syllables -= 1
+    elif letters.endswith("ed") and len(letters) > 3 and letters[-3] not in "aeiouytd":
+        syllables -= 1
+    syllables += len(SPLIT_VOWELS.findall(letters))
+    return max(1, syllables)
+
+class SyllableLexicon(object):
+    '''A class for looking up the number of syllables in a word.
+
+    Supports the same lookups as a dictionary ("word" in lexicon, lexicon["word"],
+    lexicon.get("word", default)) but can't be modified once it is built.'''
+
+    def __init__(self, entries):
+        '''entries should be an iterable of (word, syllable count) pairs, one for each
+        pronunciation of a word. The first pronunciation given for a word is taken
+        to be its main one.
+        '''
+        counts = {}
+        masks = {}
+        for word, count in entries:
+            count = min(count, MAX_SYLLABLES)
+            if word not in counts:
+                counts[word] = count
+                masks[word] = 0
+            masks[word] |= 1 << count
+        words = sorted(counts)
+        self.words = "\n".join(words)
+        self.starts = array('I', [0])
+        for word in words:
+            self.starts.append(self.starts[-1] + len(word) + 1)
+        self.counts = array('B', (counts[word] for word in words))
+        self.masks = array('H', (masks[word] for word in words))
+        self.reset_stats()
+
+    def reset_stats(self):
+        '''Empties the cache of estimated words and zeroes the lookup counters:
+        - found counts calls to pronunciations answered from the lexicon itself
+        - estimates.hits and estimates.misses count the calls for missing words that
+          were and weren't answered from the cache of estimates
+        '''
+        self.found = 0
+        self.estimates = LRUCache(self.estimate, ESTIMATE_CACHE_SIZE)
+
+    def word(self, i):
+        '''Returns word number i, in sorted order.'''
+        return self.words[self.starts[i]:self.starts[i+1] - 1]
+
+    def index(self, word):
+        '''Returns the number of "word" in sorted order, or -1 if it isn't there.'''
+        words, starts = self.words, self.starts
+        lo, hi = 0, len(self.counts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if words[starts[mid]:starts[mid+1] - 1] < word:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.counts) and words[starts[lo]:starts[lo+1] - 1] == word:
+            return lo
+        return -1
+
+    def get(self, word, default=None):
+        '''Returns the syllable count of "word", or default if it isn't in the lexicon.'''
+        i = self.index(word)
+        if i < 0:
+            return default
+        return self.counts[i]
+
+    def syllable_counts(self, word):
+        '''Returns a sorted tuple of the syllable counts of every pronunciation of
+        "word", or an empty tuple if it isn't in the lexicon.'''
+        i = self.index(word)
+        if i < 0:
+            return ()
+        mask = self.masks[i]
+        return tuple(k for k in range(MAX_SYLLABLES + 1) if mask & (1 << k))
+
+    def min_syllables(self, word):
+        '''Returns the fewest syllables "word" can be pronounced with, or None.'''
+        counts = self.syllable_counts(word)
+        return counts[0] if counts else None
+
+    def max_syllables(self, word):
+        '''Returns the most syllables "word" can be pronounced with, or None.'''
+        counts = self.syllable_counts(word)
+        return counts[-1] if counts else None
+
+    def pronunciations(self, word):
+        '''Returns a sorted tuple of the syllable counts "word" can be pronounced with.
+        For words that aren't in the lexicon, this is a one-tuple holding an estimate
+        (see estimate).'''
+        counts = self.syllable_counts(word)
+        if counts:
+            self.found += 1
+            return counts
+        return self.estimates(word)
+
+    def estimate(self, word):
+        '''Returns a one-tuple holding an estimate of the syllables in a word that isn't in
+        the lexicon. Possessives of known words ("owl's") and words made of known words
+        ("snowfields", "mountain/valley") are counted from their parts; anything else
+        is estimated from its spelling with estimate_syllables.'''
+        if word.endswith("'s") and word[:-2] in self:
+            base = word[:-2]
+            # "'s" only adds a syllable after a hissing sound ("fox's", "rose's")
+            extra = 1 if base.endswith(("s", "x", "z", "ch", "sh", "ce", "ge", "se")) else 0
+            return (self[base] + extra,)
+        parts = [part for part in re.split("[^a-z']+", word) if part]
+        if len(parts) > 1:
+            return (sum(self.pronunciations(part)[0] for part in parts),)
+        # Try splitting the word in two, longest known first part first
+        for i in range(len(word) - 3, 2, -1):
+            if word[:i] in self and word[i:] in self:
+                return (self[word[:i]] + self[word[i:]],)
+        return (estimate_syllables(word),)
+
+    def __getitem__(self, word):
+        i = self.index(word)
+        if i < 0:
+            raise KeyError(word)
+        return self.counts[i]
+
+    def __contains__(self, word):
+        return self.index(word) >= 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def save(self, filename):
+        '''Writes a snapshot of this lexicon to filename, to be read back by load.'''
+        snapshot = (LEXICON_VERSION, self.words, self.starts.tostring(), self.counts.tostring(),
+                    self.masks.tostring())
+        f = open(filename, "wb")
+        try:
+            cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+    @classmethod
+    def load(cls, filename):
+        '''Reads a lexicon snapshot written by save.'''
+        f = open(filename, "rb")
+        try:
+            snapshot = cPickle.load(f)
+        finally:
+            f.close()
+        if snapshot[0] != LEXICON_VERSION:
+            raise ValueError("%s is a version %s lexicon snapshot, expected version %s"
+                             % (filename, snapshot[0], LEXICON_VERSION))
+        version, words, starts, counts, masks = snapshot
+        lexicon = cls.__new__(cls)
+        lexicon.words = words
+        lexicon.starts = array('I')
+        lexicon.starts.fromstring(starts)
+        lexicon.counts = array('B')
+        lexicon.counts.fromstring(counts)
+        lexicon.masks = array('H')
+        lexicon.masks.fromstring(masks)
+        lexicon.reset_stats()
+        return lexicon
+
+    @classmethod
+    def from_text(cls, filename):
+        '''Reads a syllable dictionary text file, where each line is a word followed by
+        its syllable count. Alternate pronunciations such as "fire(1)" are counted
+        as pronunciations of the plain word.
+        '''
+        return cls(read_syllable_dictionary(filename))
+
+def read_syllable_dictionary(filename):
+    '''Yields a (word, syllable count) pair for each line of a syllable dictionary text file.'''
+    f = open(filename, "r")
+    try:
+        for line in f:
+            fields = line.split()
+            if len(fields) != 2 or not fields[1].isdigit():
+                continue
+            count = int(fields[1])
+            if count != 0:
+                yield base_word(fields[0]), count
+    finally:
+        f.close()
+
+def base_word(word):
+    '''Strips the "(1)" marking an alternate pronunciation from a dictionary entry.'''
+    if word.endswith(")") and "(" in word[1:]:
+        return word[:word.index("(", 1)]
+    return word
+
+def load_lexicon(filename):
+    '''Loads a lexicon from a snapshot (".lex") or a syllable dictionary text file.'''
+    if filename.endswith(".lex"):
+        return SyllableLexicon.load(filename)
+    return SyllableLexicon.from_text(filename)
+
+def get_lexicon(filename=None):
+    '''Returns the lexicon stored in filename, loading it the first time it is asked for.
+    With no filename, the default lexicon is used (see load_default_lexicon).
+    '''
+    if filename is None:
+        if None not in _lexicons:
+            _lexicons[None] = load_default_lexicon()
+        return _lexicons[None]
+    if filename not in _lexicons:
+        _lexicons[filename] = load_lexicon(filename)
+    return _lexicons[filename]
+
+def load_default_lexicon():
+    '''Loads the snapshot next to this file if it is at least as new as the syllable
+    dictionary text file. Otherwise the text file is read, and the snapshot is written
+    from it so that later processes start quickly. Not being able to write the snapshot
+    (say, in a read-only directory) is not an error.
+    '''
+    if os.path.exists(DEFAULT_SNAPSHOT) and \
+       os.path.getmtime(DEFAULT_SNAPSHOT) >= os.path.getmtime(DEFAULT_DICTIONARY):
+        try:
+            return SyllableLexicon.load(DEFAULT_SNAPSHOT)
+        except (ValueError, EOFError, cPickle.UnpicklingError):
+            pass    # Saved with an older layout, or cut short, so write it again
+    lexicon = SyllableLexicon.from_text(DEFAULT_DICTIONARY)
+    try:
+        write_default_snapshot(lexicon)
+    except (IOError, OSError):
+        pass
+    return lexicon
+
+def write_default_snapshot(lexicon):
+    '''Saves lexicon as the snapshot next to this file. It is written to a temporary file
+    first, so no other process can read half a snapshot. The snapshot should always be
+    made from the syllable dictionary text file, which is the lexicon's one source.'''
+    temporary = "%s.%d.tmp" % (DEFAULT_SNAPSHOT, os.getpid())
+    try:
+        lexicon.save(temporary)
+        os.rename(temporary, DEFAULT_SNAPSHOT)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
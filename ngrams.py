@@ -12,147 +12,327 @@ and a "generate_haiku" method
 '''
 
 from pdfsa import PDFSA
+from vocabulary import Vocabulary, ID_BITS, pack, prefix, suffix, last
+from snapshot import write_snapshot, read_snapshot
+from profiling import span
 from math import log
 from collections import defaultdict
-import re, string
+from multiprocessing import Pool, cpu_count
+from itertools import chain
+import re, string, random
 
 infinity = float("inf")
 
 # Useful functions for reading in text files as
 # corpera of sentences (word sequences)
+#
+# Each open_as_ function reads a whole file into a list. The matching iter_
+# function yields the same items one at a time while reading the file line by
+# line, so that a corpus never has to fit in memory (NgramModel accepts either).
+
+def clean_line(line):
+    '''Lowercases a line, turns hyphens into spaces and removes punctuation.'''
+    return line.lower().translate(string.maketrans("-"," "), '.!?;:,"\n')
+
+def iter_lines(filename):
+    '''Given a filename, yields each line as a list of words,
+    as determined by the position of line breaks.
+    Removes caps and punctuation.'''
+    with open(filename,"r") as f:
+        for line in f:
+            line = clean_line(line)
+            if line != "":
+                yield line.split(' ')
 
 def open_as_lines(filename):
     '''Given a filename, returns a list of lines, each one a list of words,
     as determined by the position of line breaks.
     Removes caps and punctuation.'''
-    f = open(filename,"r")
-    raw_lines = f.readlines()
-    clean_lines = [line.lower().translate(string.maketrans("-"," "), '.!?;:,"\n') \
-                   for line in raw_lines]
-    word_lines = [line.split(' ') for line in clean_lines if line != ""]
-    word_lines = filter(lambda a: len(a) > 0, word_lines)
+    word_lines = list(iter_lines(filename))
     print "Opened",filename,"as a corpus of word ngram counts."
     return word_lines
 
 # Added method, to open the file as haikus, with each set of three lines being 
 # added to the list as a single object
-def open_as_haikus(filename):
+def iter_haikus(filename):
     '''
-    Given a filename, returns a list of lists of three lines, each a list of words, 
+    Given a filename, yields each set of three lines as a list of words, 
     as determined by the position of line breaks. Also removes caps and punctuation.
     '''
-    f = open(filename,"r")
-    raw_lines = f.readlines()
-    clean_lines = [line.lower().translate(string.maketrans("-"," "), '.!?;:,"\n') \
-                   for line in raw_lines]
-    word_lines = [line.split(' ') for line in clean_lines if line != ""]
-    word_lines = filter(lambda a: len(a) > 0, word_lines)
     x = 0
     current_haiku = []
-    haiku_lines = []
-    for line in word_lines:
+    for line in iter_lines(filename):
         x += 1
         if (x%3 != 0):
             current_haiku += line
             # Removed code that would allow for distinguishing liklihoood of words ending lines            
             # current_haiku += "X"
-        # If this is the last line of a haiku, add the haiku to the list
+        # If this is the last line of a haiku, hand the haiku over
         elif (x % 3 == 0):
-            haiku_lines.append(current_haiku)
+            yield current_haiku
             current_haiku = []
-    return haiku_lines
 
+def open_as_haikus(filename):
+    '''
+    Given a filename, returns a list of lists of three lines, each a list of words, 
+    as determined by the position of line breaks. Also removes caps and punctuation.
+    '''
+    return list(iter_haikus(filename))
+
+
+def iter_sentences(filename):
+    '''Given a filename, yields each sentence as a list of words,
+    as determined by the position of characters in {!.?}.
+    Removes caps and punctuation.'''
+    def words_of(sentence):
+        return filter(lambda a: a !="'", re.sub("[^\w']", " ",  sentence).split())
+
+    # Hold on to the pieces of text since the last sentence break, since the
+    # sentence they start may carry on over the next lines
+    unfinished = []
+    with open(filename,"r") as f:
+        for line in f:
+            sentences = re.split("[!.?]", line.lower())
+            unfinished.append(sentences[0])
+            if len(sentences) == 1:
+                continue
+            sentences[0] = "".join(unfinished)
+            unfinished = [sentences.pop()]
+            for sentence in sentences:
+                word_sentence = words_of(sentence)
+                if len(word_sentence) > 0:
+                    yield word_sentence
+    word_sentence = words_of("".join(unfinished))
+    if len(word_sentence) > 0:
+        yield word_sentence
 
 def open_as_sentences(filename):
     '''Given a filename, returns a list of sentences, each a list of words,
     as determined by the position of characters in {!.?}.
     Removes caps and punctuation.'''
-    f = open(filename,"r")
-    text = f.read().lower()
-    sentences = re.split("[!.?]", text)
-    word_sentences = [filter(lambda a: a !="'", re.sub("[^\w']", " ",  sentence).split()) \
-                      for sentence in sentences]
-    word_sentences = filter(lambda a: len(a) > 0, word_sentences)
+    word_sentences = list(iter_sentences(filename))
     print "Opened",filename,"as a corpus of word ngram counts."
     return word_sentences
 
 # Useful function for reading in text files as
 # corpera of words (letter sequences)
 
+def iter_words(filename):
+    '''Given a filename, yields each word as a string,
+    as determined by the position of spaces and new lines.
+    Ignores caps and punctuation.'''
+    with open(filename,"r") as f:
+        for line in f:
+            for word in line.lower().translate(string.maketrans("-\n","  "), '.!?;:,()"\t').split():
+                yield word
+
 def open_as_words(filename):
     '''Given a filename, returns a list of words, each one a string,
     as determined by the position of spaces and new lines.
     Ignores caps and punctuation.'''
-    f = open(filename,"r")
-    words = f.read().lower().translate(string.maketrans("-\n","  "), '.!?;:,()"\t').split()
-    words = filter(lambda a: len(a) > 0, words)
+    words = list(iter_words(filename))
     print "Opened",filename,"as a corpus of letter ngram counts."
     return words
 
 #################################
 # Defining the NgramModel class #
 #################################
-class NgramModel:
-    '''A class for representing an ngram model'''
+class NgramModel(object):
+    '''A class for representing an ngram model
+
+    Symbols are numbered by self.vocabulary, and ngrams are stored packed into
+    single integers (see vocabulary.py), so the keys of ngram_counts and
+    n1gram_counts, and the states and labels of the PDFSA, are all integers.
+    Use count to look up an ngram of symbols.'''
+
+    # Bumped whenever the layout of a saved NgramModel changes
+    SNAPSHOT_VERSION = 4
     
-    def __init__(self, corpus, n, smoothing=0):
+    def __init__(self, corpus, n, smoothing=0, backoff=None, profile=None):
         '''Corpus should be a list of lists, or a list of strings (which will be treated as
-        character lists). n is the size of ngrams to be used. Smoothing is the degree
-        of laplace smoothing to be used (0.0 for no smoothing, 1 for a moderate amount).
+        character lists). It can also be any iterable of these, such as the iter_ readers
+        above: the corpus is read through only once and is not kept, so it never has to
+        be held in memory. n is the size of ngrams to be used. Smoothing is the degree
+        of laplace smoothing to be used when generating (0.0 for no smoothing, 1 for a
+        moderate amount). Backoff, if given, is the weight to use stupid backoff with
+        instead (0.4 is a usual value). See PDFSA.set_smoothing. profile, if given, is a
+        profiling.Profile to count and time training and generation with (see the
+        profile property).
         '''
+        self._profile = profile
+        with span(profile, "train"):
+            self.train(corpus, n, smoothing, backoff)
+
+    def train(self, corpus, n, smoothing, backoff):
+        '''Counts the ngrams of corpus and builds the PDFSA (see __init__).'''
         
         # Set instance variables I, F, transitions
         self.n = n
         self.smoothing = smoothing
-        self.letter_grams = type(corpus[0]) is str
+        self.backoff = backoff
+        corpus = iter(corpus)
+        try:
+            first = next(corpus)
+        except StopIteration:
+            raise ValueError("cannot train an NgramModel on an empty corpus")
+        self.letter_grams = type(first) is str
 
-        # Get sigma
-        self.sigma = set()
-        for sequence in corpus:
-            for a in sequence:
-                self.sigma.add(a)
-        
-        # Pad the corpus with start and end symbols (^ $ for letters, <s> </s> for words).
-        self.corpus = []
+        # Start and end symbols to pad sequences with (^ $ for letters, <s> </s> for words).
         if self.letter_grams:
             self.startpad, self.endpad = '^' * (self.n-1), '$'
         else:
             self.startpad, self.endpad = ['<s>'] * (self.n-1), ['</s>']
-        for seq in corpus:
-            self.corpus.append(self.startpad + seq + self.endpad)
+        self.vocabulary = Vocabulary(list(self.startpad[:1]) + list(self.endpad))
+        self.set_pad_ids()
         
-        # Get ngram counts, and n-1 gram counts by cycling through each sequence
+        # Get sigma, ngram counts, and n-1 gram counts
+        self.sigma = set()
         self.ngram_counts = defaultdict(int)
         self.n1gram_counts = defaultdict(int)
-        for sequence in self.corpus:
-            
-            # Get ngram counts, n-1 gram counts
-            for i in range(len(sequence) - self.n + 1):
-                ngram = tuple(sequence[i:i+n])
-                if ngram not in self.ngram_counts:
-                    self.ngram_counts[ngram] = 0
-                self.ngram_counts[ngram] += 1
-                
-                n1gram = tuple(sequence[i:i+n-1])
-                if n1gram not in self.n1gram_counts:
-                    self.n1gram_counts[n1gram] = 0
-                self.n1gram_counts[n1gram] += 1
+        self.count_sequences(chain([first], corpus))
 
         # Create a PDFSA for generation and probability calculation
-        I = tuple(self.startpad)
+        I = pack(self.start_ids)
         F = []
         transitions = []
         for ngram in self.ngram_counts:
-            q1 = ngram[:-1]
-            q2 = ngram[1:]
-            label = ngram[-1]
-            if label == self.endpad[0]:
+            q1 = prefix(ngram)
+            q2 = suffix(ngram, self.n)
+            label = last(ngram)
+            if label == self.end_id:
                 F.append(q1)
             else:
                 prob = self.ngram_counts[ngram] * 1.0 / self.n1gram_counts[q1]
                 transitions.append((q1,label,q2,prob))
 
-        self.fsa = PDFSA(I, F, transitions)
+        self._fsa = PDFSA(I, F, transitions, vocabulary=self.vocabulary,
+                          order=self.n, state_counts=self.n1gram_counts, profile=self._profile)
+        self._fsa.set_smoothing(smoothing, backoff)
+        self.stale_states = {}
+
+    @property
+    def profile(self):
+        '''The profiling.Profile that training, updates, scoring and generation are counted
+        and timed with, or None if they aren't. Setting it also sets the profile of the
+        PDFSA.'''
+        return self._profile
+
+    @profile.setter
+    def profile(self, profile):
+        self._profile = profile
+        self._fsa.profile = profile
+
+    def set_pad_ids(self):
+        '''Looks up the IDs of the start and end symbols.'''
+        self.start_ids = [self.vocabulary.lookup(a) for a in self.startpad]
+        self.end_id = self.vocabulary.lookup(self.endpad[0])
+
+    def pad(self, sequence, new_symbols=False):
+        '''Returns the IDs of a sequence, padded with the start and end IDs. With
+        new_symbols, symbols not yet in the vocabulary are added to it; otherwise
+        they are given the ID vocabulary.UNKNOWN.'''
+        if new_symbols:
+            ids = self.vocabulary.encode(sequence)
+        else:
+            ids = [self.vocabulary.lookup(a) for a in sequence]
+        return self.start_ids + ids + [self.end_id]
+
+    def count(self, ngram):
+        '''Returns the number of times ngram (a sequence of n symbols, or n-1 symbols
+        for an n-1 gram) was seen in training.'''
+        key = pack(self.vocabulary.lookup(a) for a in ngram)
+        if len(ngram) == self.n:
+            return self.ngram_counts.get(key, 0)
+        return self.n1gram_counts.get(key, 0)
+
+    def count_sequences(self, corpus):
+        '''Adds the symbols, ngrams and n-1 grams of every sequence in corpus to sigma,
+        ngram_counts and n1gram_counts. Returns a dictionary mapping each n-1 gram that
+        was seen to the set of symbol IDs seen following it.'''
+        n = self.n
+        mask = (1 << ID_BITS * n) - 1
+        seen = {}
+        sequences = 0
+        for seq in corpus:
+            sequences += 1
+            self.sigma.update(seq)
+            
+            # Pad the sequence, then get ngram counts, n-1 gram counts by sliding
+            # each new ID into the packed ngram and dropping the oldest one
+            ids = self.pad(seq, new_symbols=True)
+            ngram = pack(ids[:n-1])
+            for a in ids[n-1:]:
+                ngram = ((ngram << ID_BITS) | a) & mask
+                q1 = ngram >> ID_BITS
+                self.ngram_counts[ngram] += 1
+                self.n1gram_counts[q1] += 1
+                seen.setdefault(q1, set()).add(a)
+        if self._profile is not None:
+            self._profile.count("sequences_trained", sequences)
+        return seen
+
+    def update(self, corpus_chunk):
+        '''Trains this model further on corpus_chunk, a corpus of the same kind the model
+        was built from (see __init__). The counts are updated right away, and the PDFSA
+        states whose transition probabilities changed are refreshed the next time the
+        PDFSA is used, so an update costs time in proportion to the new data rather
+        than to everything the model has been trained on.'''
+        with span(self._profile, "update"):
+            for q1, labels in self.count_sequences(corpus_chunk).iteritems():
+                self.stale_states.setdefault(q1, set()).update(labels)
+
+    @property
+    def fsa(self):
+        '''The PDFSA used for generation, brought up to date with any updates first.'''
+        if self.stale_states:
+            with span(self._profile, "refresh"):
+                self.refresh_states()
+        return self._fsa
+
+    def refresh_states(self):
+        '''Recomputes the outgoing transitions of every state that update has seen new
+        data for. Each state keeps its existing transitions in order, followed by any
+        new ones.'''
+        fsa = self._fsa
+        end = self.end_id
+        for q1, labels in self.stale_states.iteritems():
+            labels_in_order = [t[1] for t in fsa.edges.get(q1, [])]
+            labels_in_order += [a for a in labels.difference(labels_in_order) if a != end]
+            total = self.n1gram_counts[q1]
+            transitions = []
+            for a in labels_in_order:
+                ngram = (q1 << ID_BITS) | a
+                transitions.append((q1, a, suffix(ngram, self.n), self.ngram_counts[ngram] * 1.0 / total))
+            fsa.update_state(q1, transitions, final=end in labels)
+        self.stale_states = {}
+
+    def save(self, filename):
+        '''Saves this model (its counts, vocabulary and PDFSA) to filename, so that it can
+        be read back with NgramModel.load instead of being trained again. The n-1 gram
+        counts are saved once, as the state counts of the PDFSA.'''
+        with span(self._profile, "save"):
+            data = (self.n, self.smoothing, self.backoff, self.letter_grams, self.startpad, self.endpad,
+                    self.sigma, dict(self.ngram_counts), self.fsa.snapshot())
+            write_snapshot(filename, "NgramModel", self.SNAPSHOT_VERSION, data)
+
+    @classmethod
+    def load(cls, filename, profile=None):
+        '''Loads a model saved with save. profile, if given, is the Profile to use (see
+        __init__), and times the loading too.'''
+        with span(profile, "load"):
+            data = read_snapshot(filename, "NgramModel", cls.SNAPSHOT_VERSION)
+            model = cls.__new__(cls)
+            (model.n, model.smoothing, model.backoff, model.letter_grams, model.startpad, model.endpad,
+             model.sigma, ngram_counts, fsa) = data
+            model.ngram_counts = defaultdict(int, ngram_counts)
+            model._fsa = PDFSA.from_snapshot(fsa, profile)
+            model.n1gram_counts = defaultdict(int, model._fsa.state_counts)
+            model._fsa.state_counts = model.n1gram_counts
+            model.vocabulary = model._fsa.vocabulary
+            model.set_pad_ids()
+            model.stale_states = {}
+            model._profile = profile
+        return model
 
     def generate(self):
         '''Probabalistically generates some sequence given this ngram
@@ -163,14 +343,68 @@ class NgramModel:
         seperator = "" if self.letter_grams else " "
         return seperator.join(sequence)
     
-    def generate_haiku(self):
+    def generate_haiku(self, constrained=False, novelty=None):
         '''Probabalistically generates some haiku given this ngram
-        language model, using its build-in pfsa.'''
-        sequence = self.fsa.generate_haiku()
+        language model, using its build-in pfsa. If constrained is True, each line is
+        sampled in a single pass that always hits its syllable count (see
+        PDFSA.generate_constrained_line) instead of by trial and error.
+        novelty, if given, is a NoveltyFilter (see novelty.py): lines that copy a
+        training line, and haikus that repeat an earlier one, are thrown away and drawn
+        again (a HaikuGenerationError is raised if that fails novelty.max_tries times).'''
+        if novelty is None:
+            sequence = self.fsa.generate_haiku(constrained=constrained)
+        else:
+            sequence = self.fsa.generate_haiku(constrained=constrained, accept_line=novelty.accept_line)
+            while not novelty.accept(sequence[1:]):
+                sequence = self.fsa.generate_haiku(constrained=constrained, accept_line=novelty.accept_line)
         
         # Make it prettier to read by converting lists to strings, with spaces if needed
         seperator = "\n"
         return seperator.join(sequence)    
+
+    def best_haikus(self, k=10, beam=1000):
+        '''Returns the k most likely haikus of this model, as a list of (log probability,
+        haiku) pairs, most likely first, with each haiku a string as generate_haiku
+        returns. They are found by beam search (see PDFSA.best_haikus), keeping the beam
+        most likely partial lines at each syllable count.'''
+        return [(score, "\n".join(sequence)) for score, sequence in self.fsa.best_haikus(k, beam)]
+
+    def generate_haikus(self, n, workers=None, seed=None, constrained=False, ordered=False):
+        '''Generates n haikus (as generate_haiku does) using a pool of worker processes,
+        yielding each one as soon as it is ready. workers is the number of processes to
+        use (by default one per core; 1 generates everything in this process).
+        The workers share this model rather than each getting a copy of it.
+        Haiku number i is always generated from the random seed (seed, i), so the same
+        seed gives the same haikus whatever the number of workers. They come back in
+        the order they finish unless ordered is True.
+        '''
+        if seed is None:
+            seed = random.getrandbits(32)
+        if workers is None:
+            workers = cpu_count()
+        if workers <= 1:
+            for i in range(n):
+                # Seeding replaces the caller's random state, so put it back between
+                # haikus (this is a generator, and the caller may use random meanwhile)
+                state = random.getstate()
+                haiku = generate_seeded_haiku(self, seed, i, constrained)
+                random.setstate(state)
+                yield haiku
+            return
+
+        # Hand out the haikus in chunks, small enough that the work stays balanced
+        chunk = max(1, min(64, n // (workers * 4)))
+        batches = [(start, min(chunk, n - start), seed, constrained) for start in range(0, n, chunk)]
+        pool = Pool(workers, initializer=set_worker_model, initargs=(self,))
+        try:
+            results = pool.imap if ordered else pool.imap_unordered
+            for batch in results(generate_haiku_batch, batches):
+                for haiku in batch:
+                    yield haiku
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
     
     def probability(self, sequence, smoothing=0.0, novel_words=0):
         '''Returns the probability of a sequence in this language model.
@@ -179,16 +413,16 @@ class NgramModel:
         observed in the training data) in the test set or other application
         '''
         prob = 1.0
-        seq = self.startpad + sequence + self.endpad
+        seq = self.pad(sequence)
+        V = len(self.sigma) + novel_words
         for i in range(len(sequence)+1):
-            ngram = tuple(seq[i:i+self.n])
-            n1gram = tuple(seq[i:i+self.n-1])
-            V = len(self.sigma) + novel_words
-            if self.ngram_counts[ngram] + smoothing == 0:
+            ngram = pack(seq[i:i+self.n])
+            count = self.ngram_counts.get(ngram, 0)
+            if count + smoothing == 0:
                 # print "missing", ngram
                 return 0.0
-            prob *= (self.ngram_counts[ngram] + smoothing * 1.0) \
-                    / (self.n1gram_counts[n1gram] + smoothing * V)
+            prob *= (count + smoothing * 1.0) \
+                    / (self.n1gram_counts.get(prefix(ngram), 0) + smoothing * V)
         return prob
 
     def log_probability_of_test_set(self, test_corpus, smoothing=0.0):
@@ -197,14 +431,65 @@ class NgramModel:
         0 and 1, the log probability will always be a negative number (or at
         most 0). A more negative number means a more unlikely corpus.
         '''
-        novel_words = set().union(*test_corpus).difference(self.sigma)
-        log_prob = 0
-        for seq in test_corpus:
-            prob = self.probability(seq, smoothing, len(novel_words))
-            if prob == 0:
-                return -infinity
-            log_prob += log(prob)
-        return log_prob
+        return self.log_probabilities_of_test_set(test_corpus, [smoothing])[0]
+
+    def log_probabilities_of_test_set(self, test_corpus, smoothings):
+        '''Returns a list with the log probability of test_corpus (as
+        log_probability_of_test_set) for each smoothing value in smoothings, which is
+        much faster than asking for each one separately when choosing a smoothing value.
+        The corpus is read through once, with every ngram replaced by its pair of
+        (ngram count, n-1 gram count) in the training data. Since many ngrams share the
+        same pair of counts, each smoothing value then only needs one log term per
+        distinct pair, weighted by how often it occurred. Working with sums of logs
+        rather than products of probabilities also means long sequences can't
+        underflow to a probability of 0.
+        '''
+        with span(self._profile, "score"):
+            ngram_counts, n1gram_counts, n = self.ngram_counts, self.n1gram_counts, self.n
+            test_symbols = set()
+            count_pairs = defaultdict(int)
+            for sequence in test_corpus:
+                test_symbols.update(sequence)
+                seq = self.pad(sequence)
+                for i in range(len(sequence)+1):
+                    ngram = pack(seq[i:i+n])
+                    count_pairs[(ngram_counts.get(ngram, 0), n1gram_counts.get(prefix(ngram), 0))] += 1
+            V = len(self.sigma) + len(test_symbols.difference(self.sigma))
+
+            log_probs = []
+            for smoothing in smoothings:
+                log_prob = 0.0
+                for (count, n1count), times in count_pairs.iteritems():
+                    if count + smoothing == 0:
+                        log_prob = -infinity
+                        break
+                    log_prob += times * (log(count + smoothing * 1.0) - log(n1count + smoothing * V))
+                log_probs.append(log_prob)
+        return log_probs
 
     lpots = log_probability_of_test_set # ...because "log_probability_of_test_set" is a pain to type
 
+##########################################
+# Helpers for NgramModel.generate_haikus #
+##########################################
+
+# The model used by each worker process, set once when the worker starts.
+# Pool workers are forked from the parent, so they share its copy of the model.
+worker_model = None
+
+def set_worker_model(model):
+    '''Initializes a worker process with the model it will generate from.'''
+    global worker_model
+    worker_model = model
+
+def generate_seeded_haiku(model, seed, i, constrained=False):
+    '''Generates haiku number i of a batch from the random seed (seed, i).'''
+    random.seed((seed << 32) + i)
+    return model.generate_haiku(constrained)
+
+def generate_haiku_batch(batch):
+    '''Generates the haikus numbered start to start + count - 1 in a worker process.'''
+    start, count, seed, constrained = batch
+    return [generate_seeded_haiku(worker_model, seed, i, constrained)
+            for i in range(start, start + count)]
+
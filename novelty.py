@@ -0,0 +1,156 @@
+'''
+Author: James Edwards
+
+This code defines the NoveltyFilter class, which keeps haikus that copy a line
+of the training set, or repeat a haiku that was already handed out, from being
+generated (see NgramModel.generate_haiku). Lines are checked as soon as they
+are generated, so a copied line is drawn again on its own rather than
+throwing away the whole haiku.
+
+Rather than keeping every line and haiku it has seen, a NoveltyFilter keeps
+them in Bloom filters (see BloomFilter), which take a fixed amount of memory
+however long the strings are, at the cost of sometimes mistaking a new haiku
+for one it has seen before. Only the most recent haikus handed out are
+remembered, so the memory used stays bounded however many are generated.
+'''
+
+import hashlib
+import struct
+from math import log, ceil
+from pdfsa import HaikuGenerationError
+
+class BloomFilter(object):
+    '''A set of strings kept as bits in a fixed amount of memory. Strings can be added but
+    not removed. A string that was added is always found, and once capacity strings
+    have been added, one that wasn't is wrongly found with probability about error_rate.
+    '''
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        # The number of bits and of hashes that give error_rate at capacity
+        self.size = int(ceil(-self.capacity * log(error_rate) / log(2) ** 2))
+        self.hashes = max(1, int(round(self.size * log(2) / self.capacity)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        '''Returns the bits that stand for item. They are made from two independent
+        hashes, h1 + i * h2 for i from 0 to hashes - 1.'''
+        # 32 bit hashes keep the arithmetic in plain ints, which is much faster than longs
+        h1, h2 = struct.unpack("<II", hashlib.md5(item).digest()[:8])
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        '''Adds the string item to the set.'''
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        for position in self.positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+def line_string(line):
+    '''Returns a line given as a list of words (or already as a string) as a string.'''
+    return line if isinstance(line, basestring) else " ".join(line)
+
+class NoveltyFilter(object):
+    '''A class for deciding whether a generated haiku is new: none of its lines may be a
+    line of the training set (see accept_line), and it may not repeat a haiku accepted
+    before (see accept).
+    - training_lines are the lines of the training set, as lists of words or as strings
+      (see ngrams.iter_lines)
+    - memory is the number of accepted haikus to remember. The most recent memory of
+      them are always remembered, and older ones are forgotten in batches of memory.
+    - error_rate is roughly the chance of a new line or haiku being mistaken for a copy
+    - max_tries is the most times in a row a line or haiku may be rejected before a
+      HaikuGenerationError is raised
+    Counts of what was checked and rejected are kept in lines_checked, copies,
+    haikus_checked, repeats and lines_discarded (see dedupe_rate).
+    '''
+
+    def __init__(self, training_lines=(), memory=100000, error_rate=0.001, max_tries=100):
+        training_lines = [line_string(line) for line in training_lines]
+        self.training = BloomFilter(len(training_lines), error_rate)
+        for line in training_lines:
+            self.training.add(line)
+        self.memory = memory
+        self.error_rate = error_rate
+        self.max_tries = max_tries
+        # Haikus are remembered in two generations. When the recent one is full it
+        # becomes the older one, and the older one is forgotten.
+        self.recent = BloomFilter(memory, error_rate)
+        self.older = None
+        self.lines_checked = 0
+        self.copies = 0
+        self.haikus_checked = 0
+        self.repeats = 0
+        self.lines_discarded = 0
+        self.rejected_in_a_row = {"line": 0, "haiku": 0}
+
+    def reject(self, what):
+        '''Counts a rejection in a row of a "line" or "haiku", raising a HaikuGenerationError
+        if there have been max_tries of them.'''
+        self.rejected_in_a_row[what] += 1
+        if self.rejected_in_a_row[what] >= self.max_tries:
+            self.rejected_in_a_row[what] = 0
+            raise HaikuGenerationError("no new %s found in %d tries" % (what, self.max_tries))
+        return False
+
+    def accept_line(self, line):
+        '''Returns True if line (a list of words or a string) is not a line of the training
+        set. Meant to be passed to PDFSA.generate_haiku as accept_line.'''
+        self.lines_checked += 1
+        if line_string(line) in self.training:
+            self.copies += 1
+            self.lines_discarded += 1
+            return self.reject("line")
+        self.rejected_in_a_row["line"] = 0
+        return True
+
+    def is_repeat(self, lines):
+        '''Returns True if the haiku made of lines has already been accepted.'''
+        haiku = "\n".join(line_string(line) for line in lines)
+        return haiku in self.recent or (self.older is not None and haiku in self.older)
+
+    def remember(self, lines):
+        '''Remembers the haiku made of lines as accepted.'''
+        if len(self.recent) >= self.memory:
+            self.older = self.recent
+            self.recent = BloomFilter(self.memory, self.error_rate)
+        self.recent.add("\n".join(line_string(line) for line in lines))
+
+    def accept(self, lines):
+        '''Returns True, and remembers the haiku, if the haiku made of lines (lists of words
+        or strings) hasn't been accepted before, and returns False if it has. Its lines
+        are expected to have been checked with accept_line already.'''
+        self.haikus_checked += 1
+        if self.is_repeat(lines):
+            self.repeats += 1
+            self.lines_discarded += len(lines)
+            return self.reject("haiku")
+        self.rejected_in_a_row["haiku"] = 0
+        self.remember(lines)
+        return True
+
+    @property
+    def dedupe_rate(self):
+        '''The fraction of lines generated that were thrown away, either as copies of
+        training lines or as part of a repeated haiku.'''
+        if self.lines_checked == 0:
+            return 0.0
+        return self.lines_discarded * 1.0 / self.lines_checked
+
+    def stats(self):
+        '''Returns a dictionary of the counts of lines and haikus checked, lines rejected as
+        copies, haikus rejected as repeats, lines thrown away, and the dedupe rate.'''
+        return {"lines_checked": self.lines_checked, "copies": self.copies,
+                "haikus_checked": self.haikus_checked, "repeats": self.repeats,
+                "lines_discarded": self.lines_discarded, "dedupe_rate": self.dedupe_rate}
@@ -5,32 +5,79 @@ Modified by James Edwards
 Modified to include the following methods:
 generate_haiku              - returns a full haiku, with line syllables = 5, 7, 5
 generate_haiku_line         - returns a single line of haiku poetry with a given syllable count
-haiku_helper                - recursive function used by the above function that helps generate a line of a haiku
-make_syllable_dictionary    - creates a dictionary object from the syllable dictionary text file
+haiku_helper                - loop used by the above function that helps generate a line of a haiku
+make_syllable_dictionary    - returns the shared syllable lexicon, loading it from disk only once
+build_index                 - indexes the transitions by state for constant time steps and stopping probabilities
+sample_edge                 - picks an outgoing edge of a state by binary searching its cumulative probabilities
+generate_constrained_line   - returns a line of haiku sampled in one pass, weighting words by completion_mass
+completion_mass             - probability of finishing a line with exactly the syllables left from a state
+save, load                  - write a PDFSA to a snapshot file and read it back
+update_state                - replaces the outgoing transitions of one state, for models trained incrementally
+set_smoothing               - samples transitions that were never seen too, by laplace smoothing or stupid backoff
+profile                     - counts and times what generation does, when set to a profiling.Profile
+best_lines, best_haikus     - return the most likely lines and haikus, found by beam search
 '''
 
 import random
+import time
+from bisect import bisect_left
+from heapq import heappush, heappop, heappushpop
+from math import log
+from lexicon import get_lexicon
+from profiling import span
+from snapshot import write_snapshot, read_snapshot
+from vocabulary import Vocabulary, ID_BITS, suffix
 
-class PDFSA:
+class PDFSA(object):
     '''A class for representing probabilistic deterministic finite state automata.
     
     Several methods have been added to generate sequences of haiku form.'''
+
+    # Default limits for generating a line of haiku (None for no limit)
+    max_attempts = 10000
+    time_budget = None
+
+    # How transitions that were never seen are sampled (see set_smoothing)
+    smoothing = 0
+    backoff = None
+
+    # The profiling.Profile to count and time things with (None to not profile)
+    profile = None
+
+    # Bumped whenever the layout of a saved PDFSA changes
+    SNAPSHOT_VERSION = 4
     
-    def __init__(self, initial_state, final_states, transitions):
+    def __init__(self, initial_state, final_states, transitions, syllable_dictionary=None, vocabulary=None,
+                 order=None, state_counts=None, profile=None):
         '''__init__ is a special "constructor" function. When creating a new instance of DFSA,
         this function will be called automatically. The user will need to provide the initial state,
         final states, and transitions.
         - transitions should be be a list of (state, label, state, probability) 4-tuples.
         - itial_state should some state in Q.
-        - final_states should be a list or set of states in Q.
+        - final_states should be a list or set of states in Q (it is stored as a set).
+        - syllable_dictionary is the syllable lexicon file used for haikus (by default the
+          one that comes with this code, see lexicon.get_lexicon).
+        - vocabulary, if given, is the Vocabulary the labels are IDs in. Sequences passed to
+          probability and returned by the generate methods are then made of the symbols
+          themselves, and the IDs are only used inside the PDFSA.
+        - order and state_counts are needed for smoothing (see set_smoothing). If the states
+          are n-1 grams of vocabulary IDs packed into integers, as NgramModel builds them,
+          order is n, and state_counts maps each state to the number of times it was seen.
+        - profile, if given, is the profiling.Profile to use (see the profile attribute),
+          and times the indexing of the transitions too.
         Rather than requiring the user to provide sigma and Q, we'll build these sets
         automatically by accumulating all the states and labels mentioned in the transitions
         '''
 
         # Set instance variables I, F, transitions
         self.I = initial_state
-        self.F = final_states
-        self.transitions = transitions
+        self.F = set(final_states)
+        self.transition_list = list(transitions)
+        self.syllable_dictionary = syllable_dictionary
+        self.vocabulary = vocabulary
+        self.order = order
+        self.state_counts = state_counts
+        self.profile = profile
         
         # Generate instance variables sigma, Q automatically by looking through the transitions
         self.sigma = set()              # Assume empty alphabet to start
@@ -40,15 +87,360 @@ class PDFSA:
             self.Q.add(q2)
             self.sigma.add(a)           # Add the label mentioned in any transition
 
+        # Index the transitions by state so that stepping, sampling and stopping
+        # don't have to scan the whole transition list for every word
+        with span(self.profile, "index"):
+            self.build_index()
+
+    def build_index(self):
+        '''Builds the per-state lookup tables used by the other methods:
+        - edges maps each state to its outgoing (state, label, state, probability) transitions,
+          in the order they appear in the transitions the PDFSA was built from
+        - cumulative maps each state to the running totals of those edges' probabilities
+        - stop_probs maps each state to the probability of stopping there
+        - steps maps each (state, label) pair to the (state, probability) it leads to
+        '''
+        self.edges = {}
+        self.steps = {}
+        for t in self.transition_list:
+            self.edges.setdefault(t[0], []).append(t)
+            if (t[0], t[1]) not in self.steps:     # The first matching transition wins, as in a scan
+                self.steps[(t[0], t[1])] = (t[2], t[3])
+
+        # Tables for generate_constrained_line, filled in as they are needed
+        self.label_syllables = {}
+        self.completion_masses = {}
+        self.constrained_cumulative = {}
+
+        # Tables for smoothing, also filled in as they are needed
+        self.label_list = None
+        self.backoff_levels = None
+        self.backoff_norms = {}
+
+        self.cumulative = {}
+        self.stop_probs = {}
+        for state in self.edges:
+            self.index_state(state)
+
+    def index_state(self, state):
+        '''Fills in the running totals and stopping probability of one state from its edges.'''
+        running_total = 0.0
+        stop_prob = 1.0
+        totals = []
+        for t in self.edges[state]:
+            running_total += t[3]
+            stop_prob -= t[3]
+            totals.append(running_total)
+        self.cumulative[state] = totals
+        self.stop_probs[state] = stop_prob
+
+    @property
+    def transitions(self):
+        '''The list of (state, label, state, probability) transitions. After update_state
+        has been used, this is rebuilt from the index (grouped by state) when next asked for.'''
+        if self.transition_list is None:
+            self.transition_list = [t for state in self.edges for t in self.edges[state]]
+        return self.transition_list
+
+    def update_state(self, state, transitions, final=False):
+        '''Replaces all the outgoing transitions of "state" with "transitions", a list of
+        (state, label, state, probability) 4-tuples, and makes it a final state if final
+        is True. Only this state is re-indexed, so the cost depends on its number of edges
+        rather than on the size of the whole PDFSA. Tables for generate_constrained_line
+        depend on every state, so they are thrown away to be rebuilt when next needed.
+        '''
+        for t in self.edges.pop(state, []):
+            self.steps.pop((t[0], t[1]), None)
+        self.cumulative.pop(state, None)
+        self.stop_probs.pop(state, None)
+        for t in transitions:
+            if (t[0], t[1]) not in self.steps:
+                self.steps[(t[0], t[1])] = (t[2], t[3])
+            self.Q.add(t[2])
+            self.sigma.add(t[1])
+        self.Q.add(state)
+        if final:
+            self.F.add(state)
+        # States with nowhere to go are left out of the index, as in build_index
+        if transitions:
+            self.edges[state] = list(transitions)
+            self.index_state(state)
+
+        self.transition_list = None
+        self.completion_masses = {}
+        self.constrained_cumulative = {}
+        self.label_list = None
+        self.backoff_levels = None
+        self.backoff_norms = {}
+
+    def set_smoothing(self, smoothing=0, backoff=None):
+        '''Sets how the generate methods sample transitions that were never seen in training.
+        By default only the transitions of the PDFSA are used. Otherwise every word can
+        follow every state, without the PDFSA ever holding all of those transitions:
+        - smoothing greater than 0 applies laplace smoothing, adding "smoothing" to the count
+          of every word (and of stopping) after every state
+        - backoff (0.4 is a usual value) applies stupid backoff: a word never seen after a
+          state is weighted by "backoff" times its weight after the state's last n-2 words,
+          backing off again as far as needed, and the weights are then normalized
+        Unseen transitions are only worked out when they are sampled, and lead to the state
+        made of the last n-1 words (see next_state), which need not be in the PDFSA.
+        This needs order and state_counts (see __init__). probability uses the same smoothed
+        distributions, but generate_constrained_line and step only follow seen transitions.
+        '''
+        if smoothing > 0 and backoff is not None:
+            raise ValueError("use either laplace smoothing or backoff, not both")
+        if (smoothing > 0 or backoff is not None) and (self.order is None or self.state_counts is None):
+            raise ValueError("smoothing needs the order and state counts of the PDFSA")
+        self.smoothing = smoothing
+        self.backoff = backoff
+        self.backoff_norms = {}
+
+    @property
+    def smoothed(self):
+        '''True if transitions that were never seen can be sampled (see set_smoothing).'''
+        return self.smoothing > 0 or self.backoff is not None
+
+    def next_state(self, state, label):
+        '''Returns the state reached from "state" by "label", whether or not that transition
+        was seen: the last order-1 IDs of the state followed by the label.'''
+        return suffix((state << ID_BITS) | label, self.order)
+
+    def labels(self):
+        '''Returns a sorted list of every label of the PDFSA, for laplace smoothing.'''
+        if self.label_list is None:
+            self.label_list = sorted(self.sigma)
+        return self.label_list
+
+    def smoothed_edge(self, state, label):
+        '''Returns the (state, label, state, probability) transition for "label" after "state"
+        under smoothing, whether or not it was seen.'''
+        next_state = self.steps.get((state, label), (None,))[0]
+        if next_state is None:
+            next_state = self.next_state(state, label)
+        return (state, label, next_state, self.smoothed_probability(state, label))
+
+    def smoothed_probability(self, state, outcome):
+        '''Returns the smoothed probability of outcome (a label, or None for stopping) after
+        "state" (see set_smoothing).'''
+        top = self.order - 1
+        if self.backoff is None:
+            count = self.state_counts.get(state, 0)
+            return (self.observed_weight(top, state, outcome) * count + self.smoothing) \
+                   / (count + self.smoothing * (len(self.labels()) + 1))
+        # Back off until the outcome has been seen, down to no context at all
+        context = state
+        weight = 1.0
+        for k in range(top, -1, -1):
+            frequency = self.observed_weight(k, context, outcome)
+            if frequency > 0:
+                return weight * frequency / self.backoff_norm(top, state)
+            if k > 0:
+                weight *= self.backoff
+                context = suffix(context, k)
+        return 0.0
+
+    def build_backoff_levels(self):
+        '''Builds the tables for backing off to shorter contexts. self.backoff_levels[k] maps
+        each context of k IDs (packed, so the empty context is 0) to a tuple of:
+        - the outcomes seen after it (labels, with None for stopping)
+        - the running totals of their relative frequencies
+        - a dictionary mapping each outcome to its relative frequency
+        The counts are added up from the states of the PDFSA that end with each context.
+        '''
+        counts = [{} for k in range(self.order - 1)]
+        for state, count in self.state_counts.iteritems():
+            if not count:
+                continue
+            outcomes = [(t[1], t[3] * count) for t in self.edges.get(state, [])]
+            if state in self.F:
+                outcomes.append((None, self.stop_probs.get(state, 1.0) * count))
+            context = state
+            for k in range(self.order - 2, -1, -1):
+                context = suffix(context, k + 1)
+                table = counts[k].setdefault(context, {})
+                for outcome, c in outcomes:
+                    table[outcome] = table.get(outcome, 0.0) + c
+
+        self.backoff_levels = []
+        for level in counts:
+            entries = {}
+            for context, table in level.iteritems():
+                total = sum(table.itervalues())
+                outcomes = sorted(table)
+                running_total = 0.0
+                totals = []
+                frequencies = {}
+                for outcome in outcomes:
+                    frequencies[outcome] = table[outcome] / total
+                    running_total += frequencies[outcome]
+                    totals.append(running_total)
+                entries[context] = (outcomes, totals, frequencies)
+            self.backoff_levels.append(entries)
+
+    def observed_outcomes(self, k, context):
+        '''Returns the outcomes (labels, with None for stopping) seen after a context of k IDs.
+        The longest contexts are the states of the PDFSA itself.'''
+        if k == self.order - 1:
+            outcomes = [t[1] for t in self.edges.get(context, [])]
+            if context in self.F:
+                outcomes.append(None)
+            return outcomes
+        if self.backoff_levels is None:
+            self.build_backoff_levels()
+        entry = self.backoff_levels[k].get(context)
+        return entry[0] if entry else []
+
+    def observed_weight(self, k, context, outcome):
+        '''Returns the relative frequency of outcome (a label, or None for stopping) after a
+        context of k IDs, or 0 if it was never seen there.'''
+        if k == self.order - 1:
+            if outcome is None:
+                return self.stop_probs.get(context, 1.0) if context in self.F else 0.0
+            return self.steps.get((context, outcome), (None, 0.0))[1]
+        if self.backoff_levels is None:
+            self.build_backoff_levels()
+        entry = self.backoff_levels[k].get(context)
+        return entry[2].get(outcome, 0.0) if entry else 0.0
+
+    def backoff_norm(self, k, context):
+        '''Returns the total stupid backoff weight of every outcome after a context of k IDs:
+        1 for the outcomes seen after it, plus "backoff" times the weight that the shorter
+        context gives the outcomes that weren't. These are cached in self.backoff_norms.
+        '''
+        key = (k, context)
+        norm = self.backoff_norms.get(key)
+        if norm is None:
+            outcomes = self.observed_outcomes(k, context)
+            norm = 1.0 if outcomes else 0.0
+            if k > 0:
+                lower = suffix(context, k)
+                unseen = self.backoff_norm(k - 1, lower) \
+                         - sum(self.observed_weight(k - 1, lower, a) for a in outcomes)
+                # Anything left over from rounding would make backoff_outcome search forever
+                if unseen > 1e-9:
+                    norm += self.backoff * unseen
+            self.backoff_norms[key] = norm
+        return norm
+
+    def backoff_outcome(self, k, context):
+        '''Draws an outcome (a label, or None for stopping) after a context of k IDs from the
+        stupid backoff distribution. An outcome seen after the context is drawn by its
+        relative frequency; otherwise one is drawn from the shorter context, again and
+        again until it is one that wasn't seen after this context.
+        '''
+        cutoff = random.random() * self.backoff_norm(k, context)
+        outcomes = self.observed_outcomes(k, context)
+        if outcomes and cutoff < 1.0:
+            if k == self.order - 1:
+                t = self.observed_edge(context, cutoff)
+                return None if t is None else t[1]
+            totals = self.backoff_levels[k][context][1]
+            return outcomes[min(bisect_left(totals, cutoff), len(outcomes) - 1)]
+        if k == 0:
+            return None
+        lower = suffix(context, k)
+        while True:
+            outcome = self.backoff_outcome(k - 1, lower)
+            if self.observed_weight(k, context, outcome) == 0:
+                return outcome
+
+    def symbol(self, label):
+        '''Returns the symbol a label stands for (the label itself if there is no vocabulary).'''
+        if self.vocabulary is None:
+            return label
+        return self.vocabulary.symbols[label]
+
+    def decode(self, labels):
+        '''Returns the list of symbols a list of labels stands for.'''
+        if self.vocabulary is None:
+            return labels
+        return self.vocabulary.decode(labels)
+
+    def encode(self, sequence):
+        '''Returns the labels for a sequence of symbols. Symbols that aren't in the
+        vocabulary get a label no transition uses.'''
+        if self.vocabulary is None:
+            return sequence
+        return [self.vocabulary.lookup(a) for a in sequence]
+
+    def snapshot(self):
+        '''Returns the data needed to rebuild this PDFSA with from_snapshot: the initial
+        state, final states, transitions, syllable dictionary, the syllable counts
+        looked up so far for its labels, the symbols of its vocabulary, and its order,
+        state counts and smoothing.
+        '''
+        symbols = None if self.vocabulary is None else self.vocabulary.symbols
+        state_counts = None if self.state_counts is None else dict(self.state_counts)
+        return (self.I, list(self.F), self.transitions, self.syllable_dictionary, self.label_syllables,
+                symbols, self.order, state_counts, self.smoothing, self.backoff)
+
+    @classmethod
+    def from_snapshot(cls, data, profile=None):
+        '''Rebuilds a PDFSA from the data returned by snapshot, using profile if given.'''
+        (initial_state, final_states, transitions, syllable_dictionary, label_syllables, symbols,
+         order, state_counts, smoothing, backoff) = data
+        vocabulary = None if symbols is None else Vocabulary(symbols)
+        fsa = cls(initial_state, final_states, transitions, syllable_dictionary, vocabulary,
+                  order, state_counts, profile)
+        fsa.label_syllables.update(label_syllables)
+        fsa.set_smoothing(smoothing, backoff)
+        return fsa
+
+    def save(self, filename):
+        '''Saves this PDFSA to filename, to be read back with PDFSA.load.'''
+        write_snapshot(filename, "PDFSA", self.SNAPSHOT_VERSION, self.snapshot())
+
+    @classmethod
+    def load(cls, filename, profile=None):
+        '''Loads a PDFSA saved with save. profile, if given, is the Profile to use, and
+        times the loading too.'''
+        with span(profile, "load"):
+            fsa = cls.from_snapshot(read_snapshot(filename, "PDFSA", cls.SNAPSHOT_VERSION), profile)
+        return fsa
+
+    def sample_edge(self, state):
+        '''Picks an outgoing edge of "state" using weighted probability, or returns None
+        if the walk should stop there instead. Unless smoothing is on (see set_smoothing),
+        exactly one random number is drawn and only seen transitions are picked.
+        '''
+        if self.backoff is not None:
+            outcome = self.backoff_outcome(self.order - 1, state)
+            return None if outcome is None else self.smoothed_edge(state, outcome)
+        if self.smoothing > 0:
+            # Laplace smoothing is the same as drawing from the seen transitions with
+            # probability count / (count + smoothing * V), and otherwise from all V
+            # outcomes evenly, so one random number covers both
+            count = self.state_counts.get(state, 0)
+            labels = self.labels()
+            cutoff = random.random() * (count + self.smoothing * (len(labels) + 1))
+            if cutoff < count:
+                t = self.observed_edge(state, cutoff / count)
+                return None if t is None else self.smoothed_edge(state, t[1])
+            i = int((cutoff - count) / self.smoothing)
+            return self.smoothed_edge(state, labels[i]) if i < len(labels) else None
+        return self.observed_edge(state, random.random())
+
+    def observed_edge(self, state, cutoff):
+        '''Returns the seen outgoing edge of "state" that a cutoff between 0 and 1 falls on,
+        or None if it falls on stopping there.
+        We imagine all the outgoing edge probabilities stacked on top of each other,
+        and binary search the running totals for the edge in the stack that overlaps
+        with the cutoff.
+        '''
+        totals = self.cumulative.get(state)
+        if not totals:
+            return None
+        i = bisect_left(totals, cutoff)
+        if i == len(totals):
+            return None
+        return self.edges[state][i]
+
     def step(self, state, label):
         '''This function returns the unique state we'll get to by being in "state"
         and accepting "label," along with the probability associated with that path.
         If there is no such state, it returns (None, 0.0).
         '''
-        for t in self.transitions:
-            if (t[0], t[1]) == (state, label):
-                return (t[2], t[3])
-        return (None, 0.0)
+        return self.steps.get((state, label), (None, 0.0))
 
     def probability(self, sequence):
         '''Returns the probability the PDFSA assigns to "sequence" (which can be either
@@ -58,19 +450,22 @@ class PDFSA:
         current_prob = 1.0          # ...with 100% probability
 
         # Read in the characters one at a time
-        for a in sequence:
+        for a in self.encode(sequence):
+            if self.smoothed:
+                current_prob *= self.smoothed_probability(current_state, a)
+                current_state = self.smoothed_edge(current_state, a)[2]
+                continue
             current_state, edge_prob = self.step(current_state, a) # Take a step, update what state we're in
             if current_state == None:   # If self.step returned None,
                 return 0.0              # ...then the derivation has failed (sequence has 0 probability)
             current_prob *= edge_prob   # Update the probability
             
         # After reading in all the characters, find the probability of stopping at this state
-        # (We could also have calculated and stored the stopping probabilities in __init__)
-        stop_prob = 1.0
-        for t in self.transitions:
-            if t[0] == current_state:   # Every time we see an outgoing transition from this final state,
-                stop_prob -= t[3]       # subtract that probability from the stopping probability.
-        return current_prob * stop_prob # The leftover probability is the probability of stopping
+        # (the leftover probability once every outgoing transition is subtracted, stored in build_index)
+        if self.smoothed:
+            return current_prob * self.smoothed_probability(current_state, None)
+        stop_prob = self.stop_probs.get(current_state, 1.0)
+        return current_prob * stop_prob
 
     def generate(self):
         '''Generates some grammatical string by taking a random walk through the FSA.
@@ -78,33 +473,25 @@ class PDFSA:
         '''
         current_state = self.I  # Start at the beginning
         sequence = []           # Start with an empty sequence
+        profile = self.profile
+        start_time = time.time()
         
         while True:
             
-            # Find all the edges leaving the current state
-            outgoing_edges = []
-            for t in self.transitions:
-                if t[0] == current_state:
-                    outgoing_edges.append(t)
-            
             # Pick an outgoing edge (or stopping) using weighted probability.
-            # We'll do this by imagining all the outgoing edge probabilities stacked on
-            # top of each other, adding to one. We'll pick a random cutoff between 0 and 1,
-            # and see which edge in the stack overlaps with that number.
-            cutoff = random.random()
-            for t in self.transitions:
-                if t[0] == current_state:
-                    cutoff -= t[3]
-                    if cutoff <= 0:
-                        next_edge = t
-                        sequence.append(next_edge[1])
-                        current_state = next_edge[2]
-                        break
+            next_edge = self.sample_edge(current_state)
+            if profile is not None:
+                profile.count("samples")
+                profile.count("edges_scanned", len(self.edges.get(current_state, ())))
             # If we went through all the outgoing edges and chose none of them, stop
-            else:
-                return sequence
+            if next_edge is None:
+                if profile is not None:
+                    profile.add_span("generate", time.time() - start_time)
+                return self.decode(sequence)
+            sequence.append(next_edge[1])
+            current_state = next_edge[2]
 
-    def generate_haiku(self):
+    def generate_haiku(self, max_attempts=None, time_budget=None, constrained=False, accept_line=None):
         '''Generates a grammatical haiku by taking a random walk through the FSA.
         This walk will be performed three times, with the first and third walks
         requiring a sequence syllable count of 5 and the second walk requiring
@@ -117,96 +504,414 @@ class PDFSA:
         [It, is, so, much, fun, for, us, all]
         [I, can't, wait, to, go]
         [|==|======|==|]
+        The statistics for each of the three lines are left in self.haiku_stats.
+        If constrained is True, each line is sampled with generate_constrained_line
+        instead, which never needs to backtrack or start over.
+        accept_line, if given, is called with each line (as a string) once it has been
+        generated, and lines it returns False for are generated again (see novelty.py).
         '''
         str = " "
         haiku = []
+        self.haiku_stats = []
         haiku.append("|==|======|==|")
-        haiku.append(str.join(self.generate_haiku_line(5)))
-        haiku.append(str.join(self.generate_haiku_line(7)))
-        haiku.append(str.join(self.generate_haiku_line(5)))
+        with span(self.profile, "generate_haiku"):
+            for syllables in (5, 7, 5):
+                while True:
+                    if constrained:
+                        line = str.join(self.generate_constrained_line(syllables))
+                    else:
+                        line = str.join(self.generate_haiku_line(syllables, max_attempts, time_budget))
+                    if accept_line is None or accept_line(line):
+                        break
+                    if self.profile is not None:
+                        self.profile.count("lines_rejected")
+                haiku.append(line)
+                self.haiku_stats.append(self.last_line_stats)
         return haiku    
         
     def make_syllable_dictionary(self, filename):
-        '''Read in a syllable dictionary text file and generate a Python dictionary
-        object where the keys correspond to words and the values correspond to
-        syllable counts.
-        '''       
-        # Create an empty dictionary object
-        syllables_dict = {}
-        # Open the syllable dictionary and store each word and its syllable count
-        # in the dictionary
-        f = open(filename,"r")
-        raw_lines = f.readlines()        
-        for line in raw_lines:
-            word = ""
-            number = 0
-            for character in line:
-                if character.isalpha():
-                    word += character
-                elif character.isdigit():
-                    number = int(character)
-            # Check that the 
-            if word != "" and number != 0:
-                syllables_dict[word] = number
-        return syllables_dict
-
-    def generate_haiku_line(self, syllables_count):
-        ''' Generates a line of haiku by calling the recursive
-        haiku_helper function.
+        '''Returns the syllable lexicon stored in filename. The keys correspond to words and
+        the values correspond to syllable counts. Lexicons are only read from disk
+        once per process and are shared by every PDFSA (see lexicon.py).
+        '''
+        return get_lexicon(filename)
+
+    def generate_haiku_line(self, syllables_count, max_attempts=None, time_budget=None):
+        ''' Generates a line of haiku by calling the haiku_helper function.
+        max_attempts is the most times the line may be started from scratch, and
+        time_budget the most seconds that may be spent on it (None for no limit).
+        If either runs out, a HaikuGenerationError is raised. Statistics about the
+        line are left in self.last_line_stats.
         '''
         current_state = self.I      # Start at the beginning
         sequence = []              # Start with an empty sequence
         limit = syllables_count     # Required syllables for this line
-        
-        # Create a dictionary object and fill it with information from our
-        # syllabes dictionary text file
-        syllables_dict = self.make_syllable_dictionary("syllableDictionary.txt")
+        if max_attempts is None:
+            max_attempts = self.max_attempts
+        if time_budget is None:
+            time_budget = self.time_budget
+
+        stats = LineStats(limit)
+        self.last_line_stats = stats
+        with span(self.profile, "generate_line"):
+            line = self.haiku_helper(limit, 0, current_state, sequence,
+                                     stats=stats, max_attempts=max_attempts, time_budget=time_budget)
+        if self.profile is not None:
+            self.profile.count("lines")
+        return self.decode(line)
+
+    def haiku_helper(self, sylLimit, sylCount, currentState, currentSeq, hasBacktracked = False,
+                     stats=None, max_attempts=None, time_budget=None):
+        ''' This method generates a line of haiku with the given number of syllables
+        by generating one word at a time, then deciding what to do next based on the
+        syllable count. If the count goes over the limit, the last word is drawn again;
+        if that fails too, or a word is reached that nothing follows, the line is started
+        over. This is a loop rather than a recursive call, so the number of restarts is
+        limited only by max_attempts and time_budget (see generate_haiku_line).
 
-        line = self.haiku_helper(syllables_dict, limit, 0, current_state, sequence)
-        return line     
+        Since a word can have several pronunciations (see word_syllables), the line
+        doesn't have a single syllable count so far but a set of possible ones, kept as
+        a bit mask (bit k is set if the line so far can be read with k syllables).
+        The count only goes over the limit if every reading does, and the line is
+        finished as soon as some reading hits the limit exactly.
 
-    def haiku_helper(self, syllableDict, sylLimit, sylCount, currentState, currentSeq, hasBacktracked = False):
-        ''' This method calls itself recursively. It generates a line of haiku 
-        with the given number of syllables by generating one word at a time,
-        then calling itself again based on the syllable count.
+        If profiling, this counts the edges sampled, the edges of the states they were
+        sampled from, the syllable lookups, the stops drawn before the line was finished,
+        and whether each restart was a dead end (a state with nowhere to go) or an
+        overshoot (a word too long twice in a row).
         '''        
+        counters = None if self.profile is None else self.profile.counters
         current_state = currentState
-        syllableCount= sylCount
         current_sequence = currentSeq
-        
-        # Find all the edges leaving the current state
-        outgoing_edges = []
-        for t in self.transitions:
-            if t[0] == current_state:
-                outgoing_edges.append(t)        
-        if outgoing_edges == []:
-            # start this line over if a point is reached where there is nowhere to proceed
-            return self.haiku_helper(syllableDict, sylLimit, 0, self.I, [])
-        cutoff = random.random()
-        for t in outgoing_edges:
-            if t[0] == current_state:
-                cutoff -= t[3]
-                #print "the cutoff is currently: " + (str)(cutoff)
-                if cutoff <= 0:
-                    if t[1] not in syllableDict:
-                        syllableDict[t[1]] = 1
-                    syllableCount += syllableDict[t[1]]
-                    if syllableCount > sylLimit:
-                        # Check if it has already had to redo the last syllable 
-                        # - if so start over entirely
-                        if hasBacktracked == True:
-                            return self.haiku_helper(syllableDict, sylLimit, 0, self.I, [])
-                        syllableCount -= syllableDict[t[1]]
-                        return self.haiku_helper(syllableDict, sylLimit, syllableCount, current_state, current_sequence, hasBacktracked = True)
-                    elif syllableCount == sylLimit: 
-                        current_sequence.append(t[1])
-                        return current_sequence
-                    elif syllableCount < sylLimit:
-                        next_edge = t
-                        current_sequence.append(next_edge[1])
-                        current_state = next_edge[2]
-                        return self.haiku_helper(syllableDict, sylLimit, syllableCount, current_state, current_sequence, hasBacktracked = False)
-            # If we went through all the outgoing edges and chose none of them, try again, because
-            # we have not reached the syllable limit yet
-        if cutoff > 0:
-            return self.haiku_helper(syllableDict, sylLimit, syllableCount, current_state, current_sequence)
\ No newline at end of file
+        limit_bit = 1 << sylLimit
+        within_limit = (limit_bit << 1) - 1
+        syllableCounts = (1 << sylCount) & within_limit
+        if stats is None:
+            stats = LineStats(sylLimit)
+        stats.attempts += 1
+        start_time = time.time()
+        deadline = None if time_budget is None else start_time + time_budget
+
+        while True:
+            if deadline is not None and time.time() > deadline:
+                stats.wall_time = time.time() - start_time
+                raise HaikuGenerationError("gave up on a %d syllable line after %.3f seconds (%s)"
+                                           % (sylLimit, stats.wall_time, stats))
+
+            # Start this line over if a point is reached where there is nowhere to proceed
+            # (with smoothing, there always is)
+            if current_state not in self.edges and not self.smoothed:
+                restart = True
+                if counters is not None:
+                    counters["dead_ends"] += 1
+            else:
+                restart = False
+                t = self.sample_edge(current_state)
+                if counters is not None:
+                    counters["samples"] += 1
+                    counters["edges_scanned"] += len(self.edges.get(current_state, ()))
+                # If we went through all the outgoing edges and chose none of them, try again, because
+                # we have not reached the syllable limit yet
+                if t is None:
+                    if counters is not None:
+                        counters["early_stops"] += 1
+                    hasBacktracked = False
+                    continue
+                # Add each reading of the word to each reading of the line so far,
+                # dropping any that go over the limit
+                newCounts = 0
+                if counters is not None:
+                    counters["syllable_lookups"] += 1
+                for wordSyllables in self.word_syllables(t[1]):
+                    newCounts |= syllableCounts << wordSyllables
+                newCounts &= within_limit
+                if newCounts == 0:
+                    # Check if it has already had to redo the last syllable 
+                    # - if so start over entirely
+                    if hasBacktracked == True:
+                        restart = True
+                        if counters is not None:
+                            counters["overshoots"] += 1
+                    else:
+                        stats.backtracks += 1
+                        if counters is not None:
+                            counters["backtracks"] += 1
+                        hasBacktracked = True
+                        continue
+                elif newCounts & limit_bit: 
+                    current_sequence.append(t[1])
+                    stats.wall_time = time.time() - start_time
+                    return current_sequence
+                else:
+                    syllableCounts = newCounts
+                    current_sequence.append(t[1])
+                    current_state = t[2]
+                    hasBacktracked = False
+
+            if restart:
+                # Counted here rather than from stats once the line is done, so that the
+                # restarts of a line that is given up on are counted too
+                if counters is not None:
+                    counters["restarts"] += 1
+                if max_attempts is not None and stats.attempts >= max_attempts:
+                    stats.wall_time = time.time() - start_time
+                    raise HaikuGenerationError("gave up on a %d syllable line after %d attempts (%s)"
+                                               % (sylLimit, stats.attempts, stats))
+                stats.attempts += 1
+                stats.restarts += 1
+                current_state = self.I
+                syllableCounts = 1
+                current_sequence = []
+                hasBacktracked = False
+
+    def word_syllables(self, label):
+        '''Returns a sorted tuple of the numbers of syllables "label" can be pronounced
+        with (see lexicon.SyllableLexicon.pronunciations). Words missing from the
+        syllable dictionary have their syllables estimated. Counts are cached per
+        label in self.label_syllables.
+        '''
+        if label not in self.label_syllables:
+            if self.profile is not None:
+                self.profile.count("lexicon_lookups")
+            syllables_dict = self.make_syllable_dictionary(self.syllable_dictionary)
+            self.label_syllables[label] = syllables_dict.pronunciations(self.symbol(label))
+        return self.label_syllables[label]
+
+    def syllables_left(self, label, remaining):
+        '''Returns the syllable budgets left after the word "label", given the budgets
+        left before it. Budgets are kept as a bit mask (bit b is set if some reading of
+        the line so far leaves b syllables), so every reading of the word (see
+        word_syllables) is taken from every budget at once. Bit 0 of the result is set
+        if some reading uses up a budget exactly, which finishes the line, as it does
+        in haiku_helper; readings that would go over are dropped.
+        '''
+        left = 0
+        for syllables in self.word_syllables(label):
+            left |= remaining >> syllables
+        return left
+
+    def completion_weight(self, t, remaining):
+        '''Returns the completion mass (see completion_mass) of the budgets left after taking
+        edge t from budgets remaining. An edge that finishes the line has a mass of 1.
+        '''
+        left = self.syllables_left(t[1], remaining)
+        if left & 1:
+            return 1.0
+        if left:
+            return self.completion_mass(t[2], left)
+        return 0.0
+
+    def completion_mass(self, state, remaining):
+        '''Returns the total probability that a walk leaving "state" (never stopping) goes
+        on to finish the line, where remaining is the bit mask of syllable budgets the
+        line so far leaves (see syllables_left):
+            mass[q][R] = sum over edges (q, a, r, p) of p * 1            if a finishes the line
+                                                        p * mass[r][R'] otherwise
+        where R' is what is left of R after a. A line is finished by the first word
+        that some reading of the whole line makes hit its syllable count exactly, so
+        words with several pronunciations are weighted exactly as haiku_helper
+        accepts them. Masses are cached in self.completion_masses, and shared by lines
+        of every length.
+        '''
+        key = (state, remaining)
+        masses = self.completion_masses
+        if key not in masses:
+            total = 0.0
+            for t in self.edges.get(state, ()):
+                total += t[3] * self.completion_weight(t, remaining)
+            masses[key] = total
+        return masses[key]
+
+    def constrained_totals(self, state, remaining):
+        '''Returns the running totals of the outgoing edges of "state", with each edge
+        weighted by its probability times the completion mass of the budgets left
+        after it (see completion_mass). These are cached in self.constrained_cumulative.
+        '''
+        key = (state, remaining)
+        if key not in self.constrained_cumulative:
+            running_total = 0.0
+            totals = []
+            for t in self.edges.get(state, []):
+                running_total += t[3] * self.completion_weight(t, remaining)
+                totals.append(running_total)
+            self.constrained_cumulative[key] = totals
+        return self.constrained_cumulative[key]
+
+    def generate_constrained_line(self, syllables_count):
+        '''Generates a line of haiku with exactly syllables_count syllables in a single
+        pass. Rather than walking at random and starting over when the count goes wrong,
+        each word is drawn in proportion to its transition probability times the
+        probability that the rest of the line can still be finished from where it leads
+        (see completion_mass), so every walk ends on the syllable limit. Each line is
+        drawn with exactly its probability given that it is finished, in the sense of
+        haiku_helper: the line ends with the first word that lets some reading of it
+        hit the limit.
+        Raises a HaikuGenerationError if no line of that length can be made.
+        Only seen transitions are followed, even if smoothing is on.
+        '''
+        stats = LineStats(syllables_count)
+        self.last_line_stats = stats
+        start_time = time.time()
+        remaining = 1 << syllables_count
+        if (self.I, remaining) not in self.completion_masses:
+            with span(self.profile, "completion_mass"):
+                self.completion_mass(self.I, remaining)
+        if self.completion_masses[(self.I, remaining)] <= 0:
+            raise HaikuGenerationError("no %d syllable line can be generated" % syllables_count)
+
+        stats.attempts = 1
+        profile = self.profile
+        current_state = self.I
+        sequence = []
+        while True:
+            totals = self.constrained_totals(current_state, remaining)
+            if profile is not None:
+                profile.count("samples")
+                profile.count("edges_scanned", len(totals))
+            i = bisect_left(totals, random.random() * totals[-1])
+            # Skip past any edges that carry no weight, in case of a cutoff of exactly 0
+            while totals[i] <= 0:
+                i += 1
+            t = self.edges[current_state][i]
+            sequence.append(t[1])
+            remaining = self.syllables_left(t[1], remaining)
+            if remaining & 1:
+                break
+            current_state = t[2]
+        stats.wall_time = time.time() - start_time
+        if profile is not None:
+            profile.count("lines")
+            profile.add_span("generate_line", stats.wall_time)
+        return self.decode(sequence)
+
+    def best_lines(self, syllables_count, k=10, beam=1000):
+        '''Returns the k most likely lines of haiku with exactly syllables_count syllables, as
+        a list of (log probability, line) pairs, most likely first. The log probability of
+        a line is the sum of the logs of the probabilities of its transitions from the
+        initial state, and each line is a list of symbols.
+
+        This is a beam search over (state, syllables so far). Since every word has at
+        least one syllable, partial lines are grouped by their number of syllables and
+        extended a group at a time, from fewest to most. Before a group is extended it
+        is pruned to its beam best partial lines, keeping at most k that end in any one
+        state, so the time and memory taken are bounded by beam, the largest number of
+        outgoing edges of a state, and syllables_count, however big the PDFSA is.
+        Without pruning (beam at least the number of partial lines) the search is exact.
+        Only seen transitions are followed, even if smoothing is on.
+        '''
+        with span(self.profile, "best_lines"):
+            # groups[s] maps each partial line with s syllables, as a linked list of labels
+            # (last label, rest of the line), to its (log probability, state)
+            groups = [{} for s in range(syllables_count)]
+            groups[0][()] = (0.0, self.I)
+            finished = []           # A heap of the k best lines found so far, worst first
+            finished_lines = set()
+            expanded = 0
+            for s in range(syllables_count):
+                for line, (score, state) in self.prune_group(groups[s], k, beam):
+                    expanded += 1
+                    for t in self.edges.get(state, ()):
+                        new_score = score + log(t[3])
+                        if len(finished) == k and new_score <= finished[0][0]:
+                            continue        # Adding words can only make it less likely
+                        new_line = (t[1], line)
+                        for syllables in self.word_syllables(t[1]):
+                            total = s + syllables
+                            if syllables <= 0 or total > syllables_count:
+                                continue
+                            if total == syllables_count:
+                                # The same line can be finished by several readings of its words
+                                if new_line not in finished_lines:
+                                    finished_lines.add(new_line)
+                                    if len(finished) < k:
+                                        heappush(finished, (new_score, new_line))
+                                    else:
+                                        finished_lines.discard(heappushpop(finished, (new_score, new_line))[1])
+                            else:
+                                group = groups[total]
+                                if new_line not in group:
+                                    group[new_line] = (new_score, t[2])
+                                    # Keep the groups still to come from growing without bound
+                                    if len(group) > 4 * beam:
+                                        groups[total] = group = dict(self.prune_group(group, k, beam))
+                groups[s] = None
+            if self.profile is not None:
+                self.profile.count("beam_expansions", expanded)
+
+        lines = []
+        while finished:
+            score, line = heappop(finished)
+            labels = []
+            while line:
+                labels.append(line[0])
+                line = line[1]
+            lines.append((score, self.decode(labels[::-1])))
+        return lines[::-1]
+
+    def prune_group(self, group, k, beam):
+        '''Returns the (partial line, (log probability, state)) pairs of the beam most likely
+        partial lines in group, keeping at most k of those ending in any one state.'''
+        kept = []
+        per_state = {}
+        for line, (score, state) in sorted(group.iteritems(), key=lambda item: item[1][0], reverse=True):
+            if per_state.get(state, 0) < k:
+                per_state[state] = per_state.get(state, 0) + 1
+                kept.append((line, (score, state)))
+                if len(kept) >= beam:
+                    break
+        return kept
+
+    def best_haikus(self, k=10, beam=1000, distinct=True):
+        '''Returns the k most likely haikus, as a list of (log probability, haiku) pairs, most
+        likely first, where each haiku is a list of lines as returned by generate_haiku.
+        The lines of a haiku are generated independently, so its log probability is the
+        sum of theirs, and the best haikus are put together from the best lines of each
+        length (see best_lines). If distinct is True, the first and last lines of a haiku
+        are never the same.
+        '''
+        fives = self.best_lines(5, k + 1 if distinct else k, beam)
+        sevens = self.best_lines(7, k, beam)
+        if not fives or not sevens or (distinct and len(fives) < 2):
+            raise HaikuGenerationError("no haiku can be generated")
+
+        # Visit combinations of line numbers (i, j, l) from the most likely down, by
+        # taking the best unvisited one and adding its neighbours (one line number one
+        # further down the list)
+        haikus = []
+        start = (0, 0, 0)
+        heap = [(-(fives[0][0] + sevens[0][0] + fives[0][0]), start)]
+        visited = set([start])
+        while heap and len(haikus) < k:
+            score, (i, j, l) = heappop(heap)
+            if not (distinct and i == l):
+                haikus.append((-score, ["|==|======|==|", " ".join(fives[i][1]), " ".join(sevens[j][1]),
+                                        " ".join(fives[l][1])]))
+            for neighbour in ((i + 1, j, l), (i, j + 1, l), (i, j, l + 1)):
+                a, b, c = neighbour
+                if a < len(fives) and b < len(sevens) and c < len(fives) and neighbour not in visited:
+                    visited.add(neighbour)
+                    heappush(heap, (-(fives[a][0] + sevens[b][0] + fives[c][0]), neighbour))
+        return haikus
+
+class LineStats:
+    '''A record of the work that went into generating one line of haiku:
+    - attempts is how many times the line was started (one more than restarts)
+    - restarts is how many times the line was thrown away and started over
+    - backtracks is how many times a word went over the syllable limit and was drawn again
+    - wall_time is how many seconds were spent on the line
+    '''
+
+    def __init__(self, syllables):
+        self.syllables = syllables
+        self.attempts = 0
+        self.restarts = 0
+        self.backtracks = 0
+        self.wall_time = 0.0
+
+    def __repr__(self):
+        return "attempts=%d, restarts=%d, backtracks=%d, wall_time=%.6f" \
+               % (self.attempts, self.restarts, self.backtracks, self.wall_time)
+
+class HaikuGenerationError(Exception):
+    '''Raised when a line of haiku can't be generated within its retry or time budget.'''
+    pass
@@ -0,0 +1,108 @@
+'''
+Author: James Edwards
+
+This code defines the Profile class, which collects counts of what happens
+inside training and generation (edges sampled, restarts, backtracks, syllable
+lookups and so on) and how long the main steps take, so that it can be seen
+where the time goes when generating haikus gets slow.
+
+Profiling is off unless a Profile is given to an NgramModel or PDFSA (see
+their profile attributes). When it is off, every place that would count or
+time something only checks that the profile is None, so it costs close to
+nothing.
+
+For example:
+    profile = Profile()
+    model = NgramModel(iter_haikus(filename), 2, profile=profile)
+    model.generate_haiku()
+    print profile
+'''
+
+import time
+from collections import defaultdict
+
+class Span(object):
+    '''Times one run of a step of a Profile, for use in a with statement.'''
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.add_span(self.name, time.time() - self.start)
+        return False
+
+class NullSpan(object):
+    '''Stands in for a Span when profiling is off, and does nothing.'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def span(profile, name):
+    '''Returns a Span timing the step called name for profile, or one that does
+    nothing if profile is None.'''
+    if profile is None:
+        return NULL_SPAN
+    return profile.span(name)
+
+class Profile(object):
+    '''A class for collecting statistics about training and generation.
+    - counters maps the name of each thing counted to its count
+    - spans maps the name of each step timed to a list of how many times it ran,
+      the total seconds it took, and the most seconds one run took
+    - callback, if given, is called with the name and seconds of every timed step
+      as soon as it finishes, for logging or watching them as they happen
+    '''
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        '''Zeroes every counter and timing.'''
+        self.counters = defaultdict(int)
+        self.spans = {}
+
+    def count(self, name, amount=1):
+        '''Adds amount to the counter called name.'''
+        self.counters[name] += amount
+
+    def span(self, name):
+        '''Returns a Span timing the step called name, for use in a with statement.'''
+        return Span(self, name)
+
+    def add_span(self, name, seconds):
+        '''Records one run of the step called name that took the given seconds.'''
+        timing = self.spans.get(name)
+        if timing is None:
+            timing = self.spans[name] = [0, 0.0, 0.0]
+        timing[0] += 1
+        timing[1] += seconds
+        if seconds > timing[2]:
+            timing[2] = seconds
+        if self.callback is not None:
+            self.callback(name, seconds)
+
+    def stats(self):
+        '''Returns the counters and timings as a dictionary, ready to be written as JSON.'''
+        spans = {}
+        for name, (runs, total, longest) in self.spans.iteritems():
+            spans[name] = {"runs": runs, "total": total, "mean": total / runs, "max": longest}
+        return {"counters": dict(self.counters), "spans": spans}
+
+    def __repr__(self):
+        lines = ["%-20s %d" % (name, self.counters[name]) for name in sorted(self.counters)]
+        for name in sorted(self.spans):
+            runs, total, longest = self.spans[name]
+            lines.append("%-20s %d runs, %.6fs total, %.6fs mean, %.6fs max"
+                         % (name, runs, total, total / runs, longest))
+        return "\n".join(lines)
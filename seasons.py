@@ -0,0 +1,200 @@
+'''
+Author: James Edwards
+
+This code defines the SeasonalModel class, an ngram model of several training
+sets (one for each season) at once, which can generate haikus from any one
+season or from a blend of them.
+
+Rather than training a separate NgramModel for each season, which would give
+every season its own vocabulary and its own copy of every ngram they share,
+a SeasonalModel numbers symbols with a single Vocabulary and stores each ngram
+once, as a row of a table with a column of counts for each season. A PDFSA for
+a season, or for a blend such as 70% Winter and 30% Spring, is built from the
+table when it is first asked for (see SeasonalModel.fsa), without training
+anything again.
+'''
+
+from array import array
+from itertools import chain
+from pdfsa import PDFSA
+from vocabulary import Vocabulary, ID_BITS, pack, suffix, last
+
+class SeasonalModel(object):
+    '''A class for representing ngram models of several corpora that share their counts.
+
+    - seasons is the list of season names, in the order of the count columns
+    - ngram_rows and n1gram_rows map each packed ngram and n-1 gram to its row
+    - ngram_columns[s][row] and n1gram_columns[s][row] are the counts of that row in season s
+    - ngram_parents[row] is the row of the n-1 gram that the ngram in that row starts with
+    Symbols are numbered by self.vocabulary, as in NgramModel.'''
+
+    def __init__(self, corpora, n):
+        '''corpora maps each season name to its corpus, which can be anything NgramModel
+        accepts (such as the iter_ readers in ngrams.py). Each corpus is read through
+        only once. Seasons are kept in the order of their names. n is the size of ngrams
+        to be used.
+        '''
+        self.n = n
+        self.seasons = sorted(corpora)
+        if not self.seasons:
+            raise ValueError("cannot train a SeasonalModel without any corpora")
+        self.vocabulary = None
+        self.sigma = set()
+        self.ngram_rows = {}
+        self.n1gram_rows = {}
+        self.ngram_columns = [array('I') for season in self.seasons]
+        self.n1gram_columns = [array('I') for season in self.seasons]
+        self.ngram_parents = array('I')
+        for column, season in enumerate(self.seasons):
+            self.count_sequences(column, corpora[season])
+
+        # PDFSAs built so far, keyed by the weights of their blend
+        self.fsas = {}
+
+    def set_pads(self, first):
+        '''Sets up the start and end symbols and the vocabulary from the first sequence
+        of the first corpus, as NgramModel does.'''
+        self.letter_grams = type(first) is str
+        if self.letter_grams:
+            self.startpad, self.endpad = '^' * (self.n-1), '$'
+        else:
+            self.startpad, self.endpad = ['<s>'] * (self.n-1), ['</s>']
+        self.vocabulary = Vocabulary(list(self.startpad[:1]) + list(self.endpad))
+        self.start_ids = [self.vocabulary.lookup(a) for a in self.startpad]
+        self.end_id = self.vocabulary.lookup(self.endpad[0])
+
+    def add_row(self, rows, columns, key):
+        '''Gives key a new row of zero counts, and returns the row.'''
+        row = rows[key] = len(rows)
+        for counts in columns:
+            counts.append(0)
+        return row
+
+    def count_sequences(self, column, corpus):
+        '''Adds the symbols, ngrams and n-1 grams of every sequence in corpus to the counts
+        of the season in the given column.'''
+        corpus = iter(corpus)
+        if self.vocabulary is None:
+            try:
+                first = next(corpus)
+            except StopIteration:
+                raise ValueError("cannot train a SeasonalModel on an empty corpus")
+            self.set_pads(first)
+            corpus = chain([first], corpus)
+
+        n = self.n
+        mask = (1 << ID_BITS * n) - 1
+        ngram_rows, n1gram_rows = self.ngram_rows, self.n1gram_rows
+        ngram_counts, n1gram_counts = self.ngram_columns[column], self.n1gram_columns[column]
+        for seq in corpus:
+            self.sigma.update(seq)
+
+            # Slide each new ID into the packed ngram, as in NgramModel.count_sequences
+            ids = self.start_ids + self.vocabulary.encode(seq) + [self.end_id]
+            ngram = pack(ids[:n-1])
+            for a in ids[n-1:]:
+                ngram = ((ngram << ID_BITS) | a) & mask
+                q1 = ngram >> ID_BITS
+                n1row = n1gram_rows.get(q1)
+                if n1row is None:
+                    n1row = self.add_row(n1gram_rows, self.n1gram_columns, q1)
+                n1gram_counts[n1row] += 1
+                row = ngram_rows.get(ngram)
+                if row is None:
+                    row = self.add_row(ngram_rows, self.ngram_columns, ngram)
+                    self.ngram_parents.append(n1row)
+                ngram_counts[row] += 1
+
+    def count(self, ngram, season):
+        '''Returns the number of times ngram (a sequence of n symbols, or n-1 symbols for an
+        n-1 gram) was seen in the training set of season.'''
+        key = pack(self.vocabulary.lookup(a) for a in ngram)
+        if len(ngram) == self.n:
+            rows, columns = self.ngram_rows, self.ngram_columns
+        else:
+            rows, columns = self.n1gram_rows, self.n1gram_columns
+        row = rows.get(key)
+        if row is None:
+            return 0
+        return columns[self.seasons.index(season)][row]
+
+    def weights(self, blend):
+        '''Returns a tuple of the weight of each season in blend, adding up to 1. blend is
+        either the name of a season, or a dictionary mapping season names to weights,
+        such as {"Winter": 0.7, "Spring": 0.3}.'''
+        if isinstance(blend, basestring):
+            blend = {blend: 1.0}
+        for season in blend:
+            if season not in self.seasons:
+                raise KeyError("no training set for season %s" % season)
+        total = float(sum(blend.values()))
+        if total <= 0:
+            raise ValueError("a blend needs some season with a positive weight")
+        return tuple(blend.get(season, 0.0) / total for season in self.seasons)
+
+    def fsa(self, blend):
+        '''Returns the PDFSA for generating from blend (see weights). The probability of
+        each transition is the blend of its probabilities in each season:
+            P(a | q) = sum over seasons s that saw q of w_s * count_s(q a) / count_s(q)
+                       divided by the sum of w_s over those seasons
+        so a state seen in only some seasons follows those seasons alone. PDFSAs are
+        built the first time a blend is asked for, and kept in self.fsas.
+        '''
+        weights = self.weights(blend)
+        if weights not in self.fsas:
+            active = [(w, self.ngram_columns[s], self.n1gram_columns[s])
+                      for s, w in enumerate(weights) if w > 0]
+
+            # The total weight of the seasons that saw each n-1 gram, by row
+            norms = [sum(w for w, counts, n1counts in active if n1counts[row])
+                     for row in xrange(len(self.n1gram_rows))]
+
+            F = []
+            transitions = []
+            parents = self.ngram_parents
+            for ngram, row in self.ngram_rows.iteritems():
+                n1row = parents[row]
+                if len(active) == 1:
+                    count = active[0][1][row]
+                    if not count:
+                        continue
+                    prob = count * 1.0 / active[0][2][n1row]
+                else:
+                    prob = 0.0
+                    for w, counts, n1counts in active:
+                        if counts[row]:
+                            prob += w * counts[row] / n1counts[n1row]
+                    if prob == 0:
+                        continue
+                    prob /= norms[n1row]
+                q1 = ngram >> ID_BITS
+                label = last(ngram)
+                if label == self.end_id:
+                    F.append(q1)
+                else:
+                    transitions.append((q1, label, suffix(ngram, self.n), prob))
+            self.fsas[weights] = PDFSA(pack(self.start_ids), F, transitions,
+                                       vocabulary=self.vocabulary, order=self.n)
+        return self.fsas[weights]
+
+    def generate(self, blend):
+        '''Probabalistically generates some sequence from blend (see weights).'''
+        sequence = self.fsa(blend).generate()
+        seperator = "" if self.letter_grams else " "
+        return seperator.join(sequence)
+
+    def generate_haiku(self, blend, constrained=False, novelty=None):
+        '''Probabalistically generates some haiku from blend (see weights), as
+        NgramModel.generate_haiku does.'''
+        fsa = self.fsa(blend)
+        accept_line = None if novelty is None else novelty.accept_line
+        sequence = fsa.generate_haiku(constrained=constrained, accept_line=accept_line)
+        if novelty is not None:
+            while not novelty.accept(sequence[1:]):
+                sequence = fsa.generate_haiku(constrained=constrained, accept_line=accept_line)
+        return "\n".join(sequence)
+
+    def best_haikus(self, blend, k=10, beam=1000):
+        '''Returns the k most likely haikus of blend (see weights), as
+        NgramModel.best_haikus does.'''
+        return [(score, "\n".join(sequence)) for score, sequence in self.fsa(blend).best_haikus(k, beam)]
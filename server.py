@@ -0,0 +1,276 @@
+'''
+Author: James Edwards
+
+This code serves haikus over HTTP from a local web server, so that a haiku can
+be had on demand without training the seasonal models again for every one (as
+trainAndGenerate.py does).
+
+Each season's NgramModel is trained (or loaded from a snapshot) once, when the
+server starts. Haikus are generated in a pool of worker processes, and a small
+buffer of finished haikus is kept for every season, refilled in the background
+as it empties, so answering a request only means taking a haiku out of a
+buffer. Python 2 has no event loop library, so requests are handled on
+threads (see HaikuServer) which never generate anything themselves.
+
+The server only listens on 127.0.0.1. It answers:
+GET /haiku/<season>     - a haiku from that season's model, as plain text
+GET /haiku              - a haiku from a random season
+GET /stats              - JSON counts of haikus buffered, served and so on, per season
+
+Run "python server.py --help" for the options.
+'''
+
+import os, sys, json, random, threading, Queue
+from argparse import ArgumentParser
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from multiprocessing import Pool, cpu_count
+from ngrams import NgramModel, iter_haikus, generate_seeded_haiku
+from pdfsa import HaikuGenerationError
+
+here = os.path.dirname(os.path.abspath(__file__))
+TRAINING_SETS = os.path.join(here, "Training Sets")
+SEASONS = ["Autumn", "Winter", "Spring", "Summer"]
+HOST = "127.0.0.1"
+
+def load_models(seasons=SEASONS, n=2, snapshot_dir=None):
+    '''Returns a dictionary mapping each season to an NgramModel of order n trained on its
+    training set. If snapshot_dir is given, models are loaded from snapshots saved there
+    (see NgramModel.save) when they are at least as new as their training sets, and
+    saved there after training otherwise.'''
+    models = {}
+    for season in seasons:
+        training_set = os.path.join(TRAINING_SETS, season + " Training.txt")
+        snapshot = None
+        if snapshot_dir is not None:
+            snapshot = os.path.join(snapshot_dir, "%s-%d.snapshot" % (season, n))
+            if os.path.exists(snapshot) and os.path.getmtime(snapshot) >= os.path.getmtime(training_set):
+                try:
+                    models[season] = NgramModel.load(snapshot)
+                    continue
+                except ValueError:
+                    pass    # Saved with an older layout, so train it again
+        models[season] = NgramModel(iter_haikus(training_set), n)
+        if snapshot is not None:
+            models[season].save(snapshot)
+    return models
+
+###########################
+# Helpers for the workers #
+###########################
+
+# The models used by each worker process, set once when the worker starts
+worker_models = None
+
+def set_worker_models(models):
+    '''Initializes a worker process with the models it will generate from.'''
+    global worker_models
+    worker_models = models
+
+def generate_season_batch(batch):
+    '''Generates the haikus numbered start to start + count - 1 for a season in a worker
+    process, leaving out any that couldn't be generated.'''
+    season, start, count, seed, constrained = batch
+    haikus = []
+    for i in range(start, start + count):
+        try:
+            haikus.append(generate_seeded_haiku(worker_models[season], seed, i, constrained))
+        except HaikuGenerationError:
+            pass
+    return haikus
+
+class HaikuService(object):
+    '''Keeps a buffer of ready haikus for each season of a dictionary of models, refilled
+    by a background thread per season that has batches generated in a shared worker pool.
+    - buffer_size is the most haikus buffered per season
+    - batch_size is how many haikus a worker generates at a time
+    - workers is the number of worker processes (by default one per core)
+    - seed makes the haikus of each season the same every time (see NgramModel.generate_haikus)
+    - constrained generates lines in a single pass (see PDFSA.generate_constrained_line)
+    '''
+
+    def __init__(self, models, buffer_size=32, batch_size=8, workers=None, seed=None, constrained=False):
+        self.models = models
+        self.seasons = sorted(models)
+        self.buffer_size = buffer_size
+        self.batch_size = min(batch_size, buffer_size)
+        self.workers = workers or cpu_count()
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.constrained = constrained
+        self.buffers = dict((season, Queue.Queue(buffer_size)) for season in self.seasons)
+        self.counts = dict((season, {"served": 0, "waited": 0, "generated": 0, "failed": 0,
+                                     "errors": 0, "last_error": None})
+                           for season in self.seasons)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.pool = None
+        self.threads = []
+
+    def start(self):
+        '''Starts the worker pool and the threads that keep the buffers full.'''
+        self.pool = Pool(self.workers, initializer=set_worker_models, initargs=(self.models,))
+        for season in self.seasons:
+            thread = threading.Thread(target=self.refill, args=(season,), name="refill-" + season)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        '''Stops refilling the buffers and shuts down the worker pool.'''
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def refill(self, season):
+        '''Keeps the buffer of a season full, until the service is stopped. Haiku number i
+        of a season is always generated from the same random seed, as in generate_haikus.'''
+        buffer = self.buffers[season]
+        # Give each season its own run of seeds
+        seed = (self.seed + self.seasons.index(season)) & 0xffffffff
+        start = 0
+        while not self.stopping.is_set():
+            result = self.pool.apply_async(generate_season_batch,
+                                           ((season, start, self.batch_size, seed, self.constrained),))
+            # Wait for the batch, checking now and then whether to stop
+            while not result.ready():
+                if self.stopping.is_set():
+                    return
+                result.wait(0.1)
+            try:
+                batch = result.get()
+            except Exception as e:
+                # Anything but a HaikuGenerationError is a bug, but it mustn't quietly stop
+                # this season from being refilled, so count it and go on to the next batch
+                with self.lock:
+                    counts = self.counts[season]
+                    counts["failed"] += self.batch_size
+                    counts["errors"] += 1
+                    counts["last_error"] = "%s: %s" % (type(e).__name__, e)
+                start += self.batch_size
+                # Don't spin if every batch fails
+                self.stopping.wait(1.0)
+                continue
+            with self.lock:
+                self.counts[season]["generated"] += len(batch)
+                self.counts[season]["failed"] += self.batch_size - len(batch)
+            start += self.batch_size
+            for haiku in batch:
+                # Wait for room in the buffer, checking now and then whether to stop
+                while not self.stopping.is_set():
+                    try:
+                        buffer.put(haiku, timeout=0.1)
+                        break
+                    except Queue.Full:
+                        pass
+
+    def get_haiku(self, season, timeout=10.0):
+        '''Returns a haiku for season, waiting up to timeout seconds for one if its buffer is
+        empty. Raises a KeyError for an unknown season, and Queue.Empty if none arrives.'''
+        buffer = self.buffers[season]
+        try:
+            haiku = buffer.get_nowait()
+            waited = 0
+        except Queue.Empty:
+            haiku = buffer.get(timeout=timeout)
+            waited = 1
+        with self.lock:
+            self.counts[season]["served"] += 1
+            self.counts[season]["waited"] += waited
+        return haiku
+
+    def stats(self):
+        '''Returns a dictionary mapping each season to how many haikus are buffered, and how
+        many have been served, served only after waiting for one, generated, and failed,
+        along with how many batches failed with an unexpected error and the last one.'''
+        with self.lock:
+            stats = dict((season, dict(counts)) for season, counts in self.counts.iteritems())
+        for season in self.seasons:
+            stats[season]["buffered"] = self.buffers[season].qsize()
+        return stats
+
+class HaikuRequestHandler(BaseHTTPRequestHandler):
+    '''Answers requests for haikus from the HaikuService of the server.'''
+
+    def do_GET(self):
+        service = self.server.service
+        path = self.path.split("?")[0].rstrip("/")
+        if path == "/stats":
+            self.respond(200, json.dumps(service.stats(), indent=2, sort_keys=True), "application/json")
+            return
+        if path == "/haiku":
+            season = random.choice(service.seasons)
+        elif path.startswith("/haiku/"):
+            season = path[len("/haiku/"):].capitalize()
+        else:
+            self.respond(404, "not found\n")
+            return
+        try:
+            haiku = service.get_haiku(season)
+        except KeyError:
+            self.respond(404, "no model for season %s\n" % season)
+        except Queue.Empty:
+            self.respond(503, "no haiku ready for %s, try again\n" % season)
+        else:
+            self.respond(200, haiku + "\n")
+
+    def respond(self, status, body, content_type="text/plain"):
+        '''Sends a response with the given status and body.'''
+        self.send_response(status)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the console quiet unless asked to log (see serve)
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class HaikuServer(ThreadingMixIn, HTTPServer):
+    '''An HTTP server handling each request on its own thread, serving haikus from service.'''
+    daemon_threads = True
+
+    def __init__(self, service, port=8000, verbose=False):
+        HTTPServer.__init__(self, (HOST, port), HaikuRequestHandler)
+        self.service = service
+        self.verbose = verbose
+
+def serve(models, port=8000, verbose=False, **options):
+    '''Serves haikus from models (see load_models) on 127.0.0.1 until interrupted. The other
+    options are passed on to HaikuService.'''
+    service = HaikuService(models, **options)
+    service.start()
+    server = HaikuServer(service, port, verbose)
+    print "Serving haikus at http://%s:%d/haiku/<season>" % server.server_address
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Serve haikus over HTTP on 127.0.0.1.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--seasons", nargs="+", default=SEASONS, choices=SEASONS)
+    parser.add_argument("--ngram", type=int, default=2, help="n of the models (default: 2)")
+    parser.add_argument("--snapshots", help="directory to load trained models from and save them to")
+    parser.add_argument("--buffer", type=int, default=32, help="haikus kept ready per season")
+    parser.add_argument("--batch", type=int, default=8, help="haikus generated per worker task")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--constrained", action="store_true",
+                        help="generate each line in a single pass")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    models = load_models(args.seasons, args.ngram, args.snapshots)
+    serve(models, args.port, args.verbose, buffer_size=args.buffer, batch_size=args.batch,
+          workers=args.workers, seed=args.seed, constrained=args.constrained)
@@ -0,0 +1,41 @@
+'''
+Author: James Edwards
+
+This code reads and writes the snapshot files used to save trained models
+(NgramModel.save, PDFSA.save) so they can be loaded again without retraining.
+
+A snapshot is a one line text header naming what kind of object it holds and
+the version of its layout, followed by the object's data in marshal format,
+which is compact and much faster to read back than it is to recount a corpus.
+'''
+
+import marshal
+
+MAGIC = "haiku-snapshot"
+
+def write_snapshot(filename, kind, version, data):
+    '''Writes data (built from tuples, lists, dicts, sets, strings and numbers)
+    to filename, labelled with its kind and layout version.'''
+    f = open(filename, "wb")
+    try:
+        f.write("%s %s %d\n" % (MAGIC, kind, version))
+        marshal.dump(data, f)
+    finally:
+        f.close()
+
+def read_snapshot(filename, kind, version):
+    '''Returns the data stored in filename by write_snapshot. Raises a ValueError
+    if the file isn't a snapshot of the given kind and version.'''
+    f = open(filename, "rb")
+    try:
+        header = f.readline().split()
+        if len(header) != 3 or header[0] != MAGIC:
+            raise ValueError("%s is not a snapshot file" % filename)
+        if header[1] != kind:
+            raise ValueError("%s holds a %s, not a %s" % (filename, header[1], kind))
+        if header[2] != str(version):
+            raise ValueError("%s is a version %s %s snapshot, expected version %d"
+                             % (filename, header[2], kind, version))
+        return marshal.load(f)
+    finally:
+        f.close()
@@ -2,53 +2,64 @@
 Author: James Edwards
 Date: 3/1/16
 
-This code reads in a phonetic dictionary of English and creates a text file
-containing all of the words in the language and the number of syllables in each
-word, with each word/syllable count appearing on its own line.
+This code reads in a phonetic dictionary of English and counts the syllables
+in every pronunciation of every word, writing them out as a text file with
+each word/syllable count appearing on its own line.
+
+Run this file to rebuild the syllable dictionary text file from the CMU
+Pronouncing Dictionary, along with the lexicon snapshot made from it (see
+lexicon.get_lexicon). The text file is the one source the haiku generator
+reads syllables from; the snapshot is only a faster copy of it.
 '''
 
-from ngrams import *
+import os
+from itertools import takewhile
+from lexicon import SyllableLexicon, DEFAULT_DICTIONARY, DEFAULT_SNAPSHOT, write_default_snapshot
+from ngrams import clean_line
+
+here = os.path.dirname(os.path.abspath(__file__))
+PRONOUNCING_DICTIONARY = os.path.join(here, "Pronouncing Dictionary.txt")
+
+def read_pronunciations(readFile):
+    '''Given the filename of a pronouncing dictionary, yields an (entry, syllable count)
+    pair for each of its lines, reading the file one line at a time. Entries are
+    turned into words as dictionary_word does, and alternate pronunciations keep
+    their "(1)" marking.'''
+    with open(readFile, "r") as f:
+        for line in f:
+            # Skip comments and blank lines
+            if line.startswith(";;;"):
+                continue
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            # Every vowel sound ends in a number marking its stress, and each vowel
+            # sound is a distinct syllable, so counting the numbers counts the syllables
+            syllables = 0
+            for phoneme in fields[1:]:
+                if phoneme[-1].isdigit():
+                    syllables += 1
+            yield dictionary_word(fields[0]), syllables
+
+def dictionary_word(entry):
+    '''Returns the word a pronouncing dictionary entry is looked up by. Entries are cleaned
+    the way training lines are (see ngrams.clean_line), so they can match the words of a
+    line. Hyphens split words in a line, so a hyphenated entry such as "fire-men" can
+    never be matched whole; its parts are run together ("firemen") instead. Entries
+    starting with punctuation, such as "-dash", give an empty word, which is written
+    out but never read back (see lexicon.read_syllable_dictionary).'''
+    return "".join(takewhile(bool, clean_line(entry).split(" ")))
 
 def generate_syllable_dictionary(readFile, writeFile):
     '''Given a filename, writes into a text file where each line is a word
     followed by two spaces, then its syllable count.'''
-    
-    # Open the phonetic dictionary and store each word and its pronunciation
-    # in a list
-    readLines = open_as_lines(readFile)
-    
-    # Opens the file that will have the syllable counts stored in it
-    toWrite = open(writeFile, "w")    
-    
-    # Go through each line in the list and count the times a number appears
-    # as each number represents a stressed syllable, and thus a distinct syllable
-    for line in readLines:
-        # Number of syllables and word for each line of dictionary
-        currentSyllables = 0
-        currentWord = ""
-        wordEnd = False
-        # Count the appearances of number characters and store the word
-        # Two loops because line holds series of words separated by spaces
-        for word in line:
-            if (word == ''):
-                wordEnd = True
-            if (wordEnd == False):
-                currentWord += word
-            else:
-                for char in word:
-                    if (char in (str(0), str(1),str(2),str(3))):
-                        currentSyllables += 1
-        # Create the full line to be added to the output text file
-        newLine = currentWord
-        newLine += "  "
-        newLine += str(currentSyllables)
-        # Add the current word and the number of syllables as a new line in the text file
-        toWrite.write(newLine)
-        toWrite.write("\n")
-    # Close the files
-    toWrite.close
-        
-
-'''Run the method, using the CMU Pronouning Dictionary as a source of syllables'''
-generate_syllable_dictionary("Pronouncing Dictionary.txt", "syllableDictionary.txt")
+    with open(writeFile, "w") as toWrite:
+        for entry, syllables in read_pronunciations(readFile):
+            toWrite.write("%s  %d\n" % (entry, syllables))
 
+if __name__ == "__main__":
+    # Rebuild the text file from the CMU Pronouncing Dictionary, then the snapshot from
+    # the text file, so the snapshot always holds exactly what the text file does
+    generate_syllable_dictionary(PRONOUNCING_DICTIONARY, DEFAULT_DICTIONARY)
+    write_default_snapshot(SyllableLexicon.from_text(DEFAULT_DICTIONARY))
+    print "Wrote", DEFAULT_DICTIONARY, "and", DEFAULT_SNAPSHOT
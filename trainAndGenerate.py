@@ -2,27 +2,35 @@
 Author: James Edwards
 Date: 3/3/2016
 
-This code will train a bigram model from a given training set, and then generate
-a haiku (or set of haikus) based on the training set.
+This code will train a bigram model from the training sets of the four seasons,
+and then generate a haiku (or set of haikus) based on each training set.
+The seasons share one SeasonalModel (see seasons.py), so words and bigrams
+that appear in more than one training set are only stored once.
 '''
 
 from ngrams import *
+from seasons import SeasonalModel
 
-def train_and_generate(training_set_filename, season):
-    '''Trains the model and generates the haiku using methods in the ngrams.py
+SEASONS = ["Autumn", "Winter", "Spring", "Summer"]
+
+def train(seasons):
+    '''Trains a bigram model of the training set of every season.'''
+    return SeasonalModel(dict((season, iter_haikus(season + " Training.txt")) for season in seasons), 2)
+
+def generate(haiku_bigram_model, season):
+    '''Generates a haiku for a season using methods in the seasons.py
     and pdfsa.py classes'''
-    training_data_set = open_as_haikus(training_set_filename)
-    haiku_bigram_model = NgramModel(training_data_set, 2)
     print "|==|======|==|"    
     print "|==|" + season + "|==|"
-    print haiku_bigram_model.generate_haiku()
+    print haiku_bigram_model.generate_haiku(season)
     
 print "The following haikus represent the four seasons."
+haiku_bigram_model = train(SEASONS)
 # Write an Autumn themed haiku
-train_and_generate("Autumn Training.txt", "Autumn")
+generate(haiku_bigram_model, "Autumn")
 # Write a Winter themed haiku
-train_and_generate("Winter Training.txt", "Winter")
+generate(haiku_bigram_model, "Winter")
 # Write a Spring themed haiku
-train_and_generate("Spring Training.txt", "Spring")
+generate(haiku_bigram_model, "Spring")
 # Write a Summer themed haiku
-train_and_generate("Summer Training.txt", "Summer")
+generate(haiku_bigram_model, "Summer")
@@ -0,0 +1,89 @@
+'''
+Author: James Edwards
+
+This code defines the Vocabulary class, which gives each symbol (word or
+letter) of a model a small integer ID, and the functions used to pack a
+sequence of IDs into a single integer.
+
+NgramModel and PDFSA work with these IDs internally: an ngram is stored as
+one integer rather than a tuple of strings, which takes far less memory, and
+symbols are only turned back into strings when a sequence is output.
+
+A packed ngram holds one ID in every ID_BITS bits, with the first symbol in
+the highest bits. That means dropping the last symbol of an ngram is a right
+shift, and dropping the first symbol is a mask (see prefix and suffix).
+'''
+
+ID_BITS = 20
+ID_MASK = (1 << ID_BITS) - 1
+
+# The ID given to symbols a vocabulary has never seen. It is never handed out,
+# so any ngram containing it has a count of 0.
+UNKNOWN = ID_MASK
+
+def pack(ids):
+    '''Packs a sequence of IDs into a single integer (0 for an empty sequence).'''
+    key = 0
+    for i in ids:
+        key = (key << ID_BITS) | i
+    return key
+
+def unpack(key, length):
+    '''Returns the tuple of "length" IDs packed into key.'''
+    ids = []
+    for k in range(length):
+        ids.append(key & ID_MASK)
+        key >>= ID_BITS
+    return tuple(reversed(ids))
+
+def prefix(key):
+    '''Drops the last ID of a packed sequence.'''
+    return key >> ID_BITS
+
+def suffix(key, length):
+    '''Drops the first ID of a packed sequence of "length" IDs.'''
+    return key & ((1 << ID_BITS * (length - 1)) - 1)
+
+def last(key):
+    '''Returns the last ID of a packed sequence.'''
+    return key & ID_MASK
+
+class Vocabulary(object):
+    '''A class for numbering symbols. IDs are handed out in the order symbols are
+    first seen, starting from 0.'''
+
+    def __init__(self, symbols=()):
+        self.symbols = []
+        self.ids = {}
+        for symbol in symbols:
+            self.id(symbol)
+
+    def id(self, symbol):
+        '''Returns the ID of symbol, giving it a new one if it doesn't have one yet.'''
+        i = self.ids.get(symbol)
+        if i is None:
+            i = len(self.symbols)
+            if i >= UNKNOWN:
+                raise OverflowError("a vocabulary can hold at most %d symbols" % UNKNOWN)
+            self.ids[symbol] = i
+            self.symbols.append(symbol)
+        return i
+
+    def lookup(self, symbol):
+        '''Returns the ID of symbol, or UNKNOWN if it doesn't have one.'''
+        return self.ids.get(symbol, UNKNOWN)
+
+    def symbol(self, i):
+        '''Returns the symbol with ID i.'''
+        return self.symbols[i]
+
+    def encode(self, sequence):
+        '''Returns the list of IDs of a sequence of symbols, numbering new symbols.'''
+        return [self.id(symbol) for symbol in sequence]
+
+    def decode(self, ids):
+        '''Returns the list of symbols with the given IDs.'''
+        return [self.symbols[i] for i in ids]
+
+    def __len__(self):
+        return len(self.symbols)